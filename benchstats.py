@@ -0,0 +1,208 @@
+import json
+import math
+import os
+import threading
+import time
+
+
+def percentile(sorted_values, percent):
+    """Returns the nearest-rank percentile of sorted_values, which must be sorted and not empty."""
+
+    # nearest rank: the smallest value that is >= percent% of the values
+    rank = int(len(sorted_values) * percent / 100.0 + 0.5)
+    index = min(max(rank - 1, 0), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(timings):
+    """Returns a dict of summary statistics for a list of timings in seconds."""
+
+    sorted_timings = sorted(timings)
+    return {
+        'count': len(sorted_timings),
+        'min': sorted_timings[0],
+        'median': percentile(sorted_timings, 50),
+        'mean': sum(sorted_timings) / len(sorted_timings),
+        'p95': percentile(sorted_timings, 95),
+        'p99': percentile(sorted_timings, 99),
+        'max': sorted_timings[-1],
+    }
+
+
+def format_summary(name, summary):
+    """Returns a one line description of summary, with times in milliseconds."""
+
+    return '%-70s min %8.3f  median %8.3f  p95 %8.3f  p99 %8.3f ms (%d runs)' % (
+        name, summary['min'] * 1000, summary['median'] * 1000, summary['p95'] * 1000,
+        summary['p99'] * 1000, summary['count'])
+
+
+def run_concurrently(func, check, num_threads, calls_per_thread):
+    """Calls func calls_per_thread times from each of num_threads threads, all started at once.
+    check is called with each result, and returns an error message if it is wrong, or None.
+    Returns (list of the latency of every call, elapsed seconds for all calls, list of errors);
+    exceptions raised by func are errors."""
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start_event = threading.Event()
+
+    def worker():
+        start_event.wait()
+        thread_latencies = []
+        thread_errors = []
+        for _ in xrange(calls_per_thread):
+            start = time.time()
+            try:
+                error = check(func())
+            except Exception, e:
+                error = '%s: %s' % (type(e).__name__, e)
+            thread_latencies.append(time.time() - start)
+            if error is not None:
+                thread_errors.append(error)
+        with lock:
+            latencies.extend(thread_latencies)
+            errors.extend(thread_errors)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(num_threads)]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    return latencies, time.time() - start, errors
+
+
+def format_concurrency(name, num_threads, latencies, elapsed, errors):
+    """Returns a one line description of the results of run_concurrently."""
+
+    summary = summarize(latencies)
+    return '%-40s %3d threads: %8.1f calls/s  median %8.3f  p95 %8.3f  p99 %8.3f ms  %d errors' % (
+        name, num_threads, len(latencies) / elapsed, summary['median'] * 1000,
+        summary['p95'] * 1000, summary['p99'] * 1000, len(errors))
+
+
+def runtime_name():
+    """Returns a description of the runtime these benchmarks are running in."""
+
+    runtime = os.environ.get('SERVER_SOFTWARE', 'unknown')
+    if os.environ.get('GAE_VM'):
+        runtime += ' (flexible)'
+    return runtime
+
+
+def make_record(scenario, model_name, property_count, entity_count, timings, runtime=None):
+    """Returns a JSON-serializable dict describing one benchmark measurement. timings is the list
+    of per-iteration times in seconds."""
+
+    if runtime is None:
+        runtime = runtime_name()
+    return {
+        'scenario': scenario,
+        'model_class': model_name,
+        'property_count': property_count,
+        'entity_count': entity_count,
+        'runtime': runtime,
+        'timings': list(timings),
+        'stats': summarize(timings),
+    }
+
+
+def write_json(records, f):
+    json.dump({'records': records}, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)['records']
+
+
+def record_id(record):
+    """Returns the fields that identify the same measurement in two sets of records."""
+
+    return (record['scenario'], record['model_class'], record['entity_count'])
+
+
+# a slowdown is only reported if it is significant with this probability of a false positive
+DEFAULT_ALPHA = 0.01
+# ... and the median is at least this fraction slower
+DEFAULT_MIN_SLOWDOWN = 0.05
+
+
+def compare(baseline_records, records, alpha=DEFAULT_ALPHA, min_slowdown=DEFAULT_MIN_SLOWDOWN):
+    """Compares records with the matching baseline_records. Returns a list of dicts, one per
+    record that has a baseline, with 'regression' set to True if it is significantly slower: the
+    one-sided Mann-Whitney U test of the timings has a p-value less than alpha, and the median is
+    at least min_slowdown slower. Timings are rarely normally distributed, so this uses ranks
+    rather than means."""
+
+    baselines = dict((record_id(record), record) for record in baseline_records)
+    comparisons = []
+    for record in records:
+        baseline = baselines.get(record_id(record))
+        if baseline is None:
+            continue
+        baseline_median = baseline['stats']['median']
+        median = record['stats']['median']
+        if baseline_median > 0:
+            ratio = median / baseline_median
+        else:
+            ratio = float('inf') if median > 0 else 1.0
+        p_value = mann_whitney_greater(record['timings'], baseline['timings'])
+        comparisons.append({
+            'id': record_id(record),
+            'baseline_median': baseline_median,
+            'median': median,
+            'ratio': ratio,
+            'p_value': p_value,
+            'regression': p_value < alpha and ratio >= 1 + min_slowdown,
+        })
+    return comparisons
+
+
+def format_comparison(comparison):
+    scenario, model_name, entity_count = comparison['id']
+    flag = 'REGRESSION' if comparison['regression'] else 'ok'
+    return '%-10s %s %s (%d entities): median %.3f -> %.3f ms (%.2fx, p=%.4f)' % (
+        flag, model_name, scenario, entity_count, comparison['baseline_median'] * 1000,
+        comparison['median'] * 1000, comparison['ratio'], comparison['p_value'])
+
+
+def mann_whitney_greater(samples, baseline_samples):
+    """Returns the approximate p-value of the one-sided Mann-Whitney U test that samples tend to
+    be greater than baseline_samples, using the normal approximation with tie and continuity
+    corrections. Needs about 10 or more samples in each to be accurate."""
+
+    n1 = len(samples)
+    n2 = len(baseline_samples)
+    if n1 == 0 or n2 == 0:
+        return 1.0
+
+    combined = sorted([(value, 0) for value in samples] + [(value, 1) for value in baseline_samples])
+    n = n1 + n2
+    rank_sum = 0.0
+    tie_sum = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        # ranks are 1-based; tied values all get the average rank
+        average_rank = (i + j + 2) / 2.0
+        ties = j - i + 1
+        tie_sum += ties ** 3 - ties
+        for k in xrange(i, j + 1):
+            if combined[k][1] == 0:
+                rank_sum += average_rank
+        i = j + 1
+
+    u = rank_sum - n1 * (n1 + 1) / 2.0
+    mean = n1 * n2 / 2.0
+    variance = n1 * n2 / 12.0 * ((n + 1) - tie_sum / (n * (n - 1))) if n > 1 else 0.0
+    if variance <= 0:
+        return 1.0
+    z = (u - mean - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
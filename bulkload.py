@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+import argparse
+import collections
+import hashlib
+import logging
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+
+import datastore_lazy
+import modelgen
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_MAX_RETRIES = 3
+# seconds before the first retry of a chunk; doubled for each further retry
+DEFAULT_RETRY_DELAY = 0.1
+# errors that may succeed if the same put is retried
+RETRY_ERRORS = (
+    datastore_errors.Timeout,
+    datastore_errors.InternalError,
+    datastore_errors.TransactionFailedError,
+    apiproxy_errors.DeadlineExceededError,
+)
+
+
+class LoadStats(object):
+    """Counts for a load: entities and chunks written, chunks retried, and elapsed seconds."""
+
+    def __init__(self):
+        self.entities = 0
+        self.chunks = 0
+        self.retries = 0
+        self.seconds = 0.0
+
+    def entities_per_second(self):
+        if self.seconds == 0:
+            return 0.0
+        return self.entities / self.seconds
+
+    def summary(self):
+        return '%d entities in %d chunks in %.1f s (%.0f entities/s, %d retries)' % (
+            self.entities, self.chunks, self.seconds, self.entities_per_second(), self.retries)
+
+
+def generate(model_classes, count):
+    """Yields count random instances of each of model_classes, created with modelgen.instance one
+    at a time, so they never all need to be in memory."""
+
+    for _ in xrange(count):
+        for model_class in model_classes:
+            yield modelgen.instance(model_class)
+
+
+def generate_protos(model_classes, count, seed=0):
+    """Yields count EntityProtos for each of model_classes, generated by modelgen.BulkGenerator:
+    much faster than generate, and the same seed always produces the same entities and keys."""
+
+    generators = [modelgen.BulkGenerator(model_class, _kind_seed(seed, model_class))
+        for model_class in model_classes]
+    iterators = [generator.entity_protos(count) for generator in generators]
+    for _ in xrange(count):
+        for iterator in iterators:
+            yield iterator.next()
+
+
+def _kind_seed(seed, model_class):
+    """Returns the random seed for the entities of model_class: a hash of seed and the kind, so
+    each kind gets different data for each seed. (With seed + index, the second class with seed N
+    would get the same data as the first class with seed N + 1.)"""
+
+    if issubclass(model_class, db.Model):
+        kind = model_class.kind()
+    else:
+        kind = model_class._get_kind()
+    return int(hashlib.md5('%d:%s' % (seed, kind)).hexdigest(), 16)
+
+
+def load(instances, chunk_size=DEFAULT_CHUNK_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+        max_retries=DEFAULT_MAX_RETRIES, retry_delay=DEFAULT_RETRY_DELAY, report_seconds=10.0):
+    """Puts instances, an iterable of db.Model and/or ndb.Model instances (e.g. from generate) or
+    EntityProtos (e.g. from generate_protos), in chunks of chunk_size, with up to max_in_flight
+    db.put_async, ndb.put_multi_async or datastore_lazy.put_async RPCs running at once. Instances
+    are consumed as chunks are started, so a generator is never fully in memory. A chunk that fails
+    with one of RETRY_ERRORS is put again up to max_retries times, waiting retry_delay seconds,
+    doubled after each retry; other errors, or running out of retries, raise the error. A timed out
+    put may still have been written, so models without a complete key are given allocated ids before
+    their first put, which makes a retry overwrite the same entities instead of creating duplicates;
+    chunks with other incomplete keys (e.g. EntityProtos) are not retried. ndb puts skip the context
+    cache and memcache, so loaded entities are not kept in memory. Logs progress every
+    report_seconds (None to disable), and returns the LoadStats."""
+
+    stats = LoadStats()
+    start = time.time()
+    last_report = start
+    in_flight = collections.deque()
+    # db, ndb and EntityProto instances are put in separate chunks
+    chunks = {}
+
+    def start_chunk(chunk):
+        while len(in_flight) >= max_in_flight:
+            finish_oldest()
+        in_flight.append(_Chunk(chunk))
+
+    def finish_oldest():
+        chunk = in_flight.popleft()
+        while True:
+            try:
+                chunk.get_result()
+                break
+            except RETRY_ERRORS, e:
+                if not chunk.retryable or chunk.attempts > max_retries:
+                    raise
+                stats.retries += 1
+                logging.warning('bulkload: retrying a chunk of %d entities after %s: %s',
+                    len(chunk.instances), type(e).__name__, e)
+                time.sleep(retry_delay * (2 ** (chunk.attempts - 1)))
+                chunk.start()
+        stats.entities += len(chunk.instances)
+        stats.chunks += 1
+
+    for instance in instances:
+        chunk = chunks.setdefault(_chunk_type(instance), [])
+        chunk.append(instance)
+        if len(chunk) >= chunk_size:
+            start_chunk(list(chunk))
+            del chunk[:]
+
+        if report_seconds is not None:
+            now = time.time()
+            if now - last_report >= report_seconds:
+                stats.seconds = now - start
+                logging.info('bulkload: %s so far', stats.summary())
+                last_report = now
+
+    for chunk in chunks.itervalues():
+        if chunk:
+            start_chunk(chunk)
+    while in_flight:
+        finish_oldest()
+
+    stats.seconds = time.time() - start
+    if report_seconds is not None:
+        logging.info('bulkload: %s', stats.summary())
+    return stats
+
+
+def _chunk_type(instance):
+    if isinstance(instance, entity_pb.EntityProto):
+        return entity_pb.EntityProto
+    if isinstance(instance, db.Model):
+        return db.Model
+    return ndb.Model
+
+
+def _complete_keys(instances):
+    """Gives db and ndb models without a complete key an allocated id, so putting them again writes
+    the same entities. Returns True if all instances now have complete keys."""
+
+    incomplete = collections.defaultdict(list)
+    for instance in instances:
+        if isinstance(instance, entity_pb.EntityProto):
+            last = instance.key().path().element_list()[-1]
+            if not last.id() and not last.name():
+                return False
+        elif isinstance(instance, db.Model):
+            if not instance.has_key():
+                incomplete[(type(instance), instance.parent_key())].append(instance)
+        elif not instance._has_complete_key():
+            parent = None
+            if instance.key is not None:
+                parent = instance.key.parent()
+            incomplete[(type(instance), parent)].append(instance)
+
+    for (model_class, parent), models in incomplete.iteritems():
+        if issubclass(model_class, db.Model):
+            start, _ = db.allocate_ids(
+                db.Key.from_path(model_class.kind(), 1, parent=parent), len(models))
+            for i, model in enumerate(models):
+                # the attribute db.Model.__init__ sets when called with key=
+                model._key = db.Key.from_path(model_class.kind(), start + i, parent=parent)
+        else:
+            start, _ = model_class.allocate_ids(size=len(models), parent=parent)
+            for i, model in enumerate(models):
+                model.key = ndb.Key(model_class._get_kind(), start + i, parent=parent)
+    return True
+
+
+class _Chunk(object):
+    """A chunk of db models, ndb models or EntityProtos being put."""
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.attempts = 0
+        self.retryable = _complete_keys(instances)
+        self.start()
+
+    def start(self):
+        self.attempts += 1
+        chunk_type = _chunk_type(self.instances[0])
+        if chunk_type is entity_pb.EntityProto:
+            self.__rpc = datastore_lazy.put_async(self.instances)
+            self.__futures = None
+        elif chunk_type is db.Model:
+            self.__rpc = db.put_async(self.instances)
+            self.__futures = None
+        else:
+            self.__rpc = None
+            self.__futures = ndb.put_multi_async(self.instances, use_cache=False,
+                use_memcache=False)
+
+    def get_result(self):
+        if self.__rpc is not None:
+            return self.__rpc.get_result()
+        return [future.get_result() for future in self.__futures]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Loads random entities into the local datastore stub, and reports the rate')
+    parser.add_argument('--count', type=int, default=1000,
+        help='entities of each model class (default %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+        help='entities per put (default %(default)s)')
+    parser.add_argument('--in-flight', type=int, default=DEFAULT_MAX_IN_FLIGHT,
+        help='puts running at once (default %(default)s)')
+    parser.add_argument('--models', dest='use_models', action='store_true',
+        help='put generated models instead of EntityProtos (much slower to generate)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed for the generated EntityProtos (default %(default)s)')
+    parser.add_argument('models', nargs='*', metavar='MODEL',
+        help='model classes to load (default: all of perf.MODEL_CLASSES)')
+    return parser.parse_args()
+
+
+def main():
+    # only needed to run from the command line
+    import localbench
+
+    logging.getLogger().setLevel(logging.INFO)
+    args = parse_args()
+    model_classes = localbench.select_model_classes(args.models)
+    bed = localbench.setup_testbed()
+    try:
+        if args.use_models:
+            instances = generate(model_classes, args.count)
+        else:
+            instances = generate_protos(model_classes, args.count, args.seed)
+        stats = load(instances, args.chunk_size, args.in_flight)
+    finally:
+        bed.deactivate()
+    print stats.summary()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,18 @@
+import array
+import functools
+import logging
+import threading
+
 from google.appengine.api import datastore
 from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_query
 from google.appengine.datastore import datastore_rpc
 from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
+from google.appengine.ext import ndb
 
 
-def get(keys):
+def get(keys, model_class=None, compact=False, projection=None):
     """Get LazyEntities for each datastore object corresponding to the keys in keys. keys must be
     a list of db.Key objects. Deserializing datastore objects with many properties is very slow
     (~10 ms for an entity with 170 properties). google.appengine.api.datastore.GetAsync avoids
@@ -23,58 +30,664 @@ def get(keys):
     This bypasses a lot of parsing by returning the EntityProto wrapped in a LazyEntity. Its likely
     to be quite a bit faster in many cases.
 
+    keys may also be ndb.Keys. For ndb models, see also LazyNdbModel.
+
+    If model_class is the db.Model or ndb.Model subclass for the keys, properties are converted with
+    the decoders returned by compile_decoders. If compact is True, entities are returned as
+    CompactLazyEntity instead, which use less memory.
+
+    If projection is a list of property names, entities are returned as ProjectedLazyEntity, which
+    keep only those properties. The whole entity is still transferred and parsed, but the rest is
+    dropped immediately, which uses much less memory when holding many wide entities.
+
+    Inside a transaction, this gets the entities the normal way, so the read is part of the
+    transaction, and converts them back to EntityProtos: the result is the same, but it is slower
+    than db.get. The same happens if the SDK's internals have changed (see _SDK_ERROR).
+
     If this breaks, it probably means the internal API has changed."""
 
     # db.get calls db.get_async calls datastore.GetAsync
     # datastore.GetAsync then calls _GetConnection(), then Connection.async_get
-    # _GetConnection returns a thread-local so it should be safe to hack it in this way
-    # datastore_rpc.BaseConnection uses self.__adapter.pb_to_entity to convert the entity
-    # protocol buffer into an Entity: skip that step and return a LazyEntity instead
-    connection = datastore._GetConnection()
-    if connection._api_version != datastore_rpc._DATASTORE_V3:
-        raise Exception("Unsupported API version: " + connection._api_version)
-    # patch the connection because it is thread-local. Previously we patched adapter.pb_to_entity
-    # which is shared. This caused exceptions in other threads under load. Oops.
-    real_adapter = connection._BaseConnection__adapter
-    wrapped_adapter = DatastoreLazyEntityAdapter(real_adapter)
-    connection._BaseConnection__adapter = wrapped_adapter
+    # datastore_rpc.BaseConnection uses its adapter's pb_to_entity to convert the entity
+    # protocol buffer into an Entity: use a connection whose adapter skips that step and returns a
+    # LazyEntity instead
+    keys, _ = datastore.NormalizeAndTypeCheckKeys(_to_db_keys(keys))
+    connection = _lazy_connection(model_class, compact, projection)
+    if connection is None:
+        return _get_normally(keys, _entity_factory(model_class, compact, projection))
+    return connection.async_get(None, keys).get_result()
+
+
+def get_async(keys, batch_size=None, model_class=None, compact=False, projection=None):
+    """Starts getting LazyEntities for keys, and returns an RPC. Call its get_result() method to
+    get the list of LazyEntities, with None for keys that do not exist. Any number of these can be
+    in flight at once, along with other RPCs. If batch_size is set, keys are split into parallel
+    RPCs of at most batch_size keys each; the results are in the same order as keys. Unlike get,
+    this reads outside of any current transaction, unless the SDK's internals have changed.
+    model_class, compact and projection are the same as for get."""
+
+    config = None
+    if batch_size is not None:
+        config = datastore_rpc.Configuration(max_get_keys=batch_size)
+    keys, _ = datastore.NormalizeAndTypeCheckKeys(_to_db_keys(keys))
+    connection = _lazy_connection(model_class, compact, projection, transactional=False)
+    if connection is None:
+        factory = _entity_factory(model_class, compact, projection)
+        return datastore.GetAsync(keys, config=config,
+            extra_hook=lambda entities: _entities_to_lazy(entities, factory))
+    return connection.async_get(config, keys)
+
+
+def get_columns(keys, property_names, model_class=None):
+    """Gets the entities for keys, and converts only property_names, in one pass over all the
+    entities. Returns a dict of property name -> list of values, with one value per entity that
+    exists, in the same order as keys, plus '__key__' -> list of the keys of those entities. A
+    missing property is None. This avoids creating an object per entity and looking up the
+    conversion for every value. model_class is the same as for get; if it is set, columns of
+    integer and float properties are returned as array.array (which can be passed to e.g.
+    numpy.frombuffer without copying), unless they contain None or lists."""
+
+    decoders = _NO_DECODERS
+    if model_class is not None:
+        decoders = compile_decoders(model_class)
+    names = list(property_names)
+    column_indexes = dict((name, i) for i, name in enumerate(names))
+    column_decoders = [decoders.get(name, datastore_types.FromPropertyPb) for name in names]
+
+    keys, _ = datastore.NormalizeAndTypeCheckKeys(_to_db_keys(keys))
+    connection = _lazy_connection(entity_factory=_return_entity_proto)
+    if connection is None:
+        entity_protos = _get_normally(keys, _return_entity_proto)
+    else:
+        entity_protos = connection.async_get(None, keys).get_result()
+
+    key_column = []
+    columns = [[] for name in names]
+    for entity_proto in entity_protos:
+        if entity_proto is None:
+            continue
+        key_column.append(db.Key._FromPb(entity_proto.key()))
+        row = [None] * len(names)
+        for prop_list in (entity_proto.property_list(), entity_proto.raw_property_list()):
+            for prop in prop_list:
+                i = column_indexes.get(prop.name())
+                if i is None:
+                    continue
+                if prop.multiple():
+                    if row[i] is None:
+                        row[i] = [prop]
+                    else:
+                        row[i].append(prop)
+                else:
+                    row[i] = prop
+        for i, prop in enumerate(row):
+            if prop is None:
+                value = None
+            elif isinstance(prop, list):
+                decode = column_decoders[i]
+                value = [decode(p) for p in prop]
+            else:
+                value = column_decoders[i](prop)
+            columns[i].append(value)
+
+    result = {'__key__': key_column}
+    for name, decode, column in zip(names, column_decoders, columns):
+        typecode = _ARRAY_TYPECODES.get(decode)
+        if typecode is not None:
+            try:
+                column = array.array(typecode, column)
+            except (TypeError, OverflowError):
+                # contains None or lists: leave it as a list
+                pass
+        result[name] = column
+    return result
+
+
+def _return_entity_proto(entity_proto):
+    return entity_proto
+
+
+def put(entities):
+    """Writes LazyEntities returned by get back to the datastore, and returns their keys. The
+    EntityProto each LazyEntity wraps is sent as-is, except that properties assigned (or deleted)
+    since it was fetched are re-encoded. This skips the db.Model -> datastore.Entity -> EntityProto
+    conversion that makes writing wide models slow, so a read-modify-write costs roughly one
+    protocol buffer serialization.
+
+    Assigned properties stay indexed or unindexed as they were when fetched. New properties are
+    indexed, unless their value is never indexed (e.g. db.Text).
+
+    entities may also contain db.Model instances, which are converted with model_to_pb, including
+    auto_now properties. Like db.put, models are then saved (is_saved() is True), with the
+    allocated key if they did not have a complete key. EntityProtos are sent as-is.
+
+    Inside a transaction, or if the SDK's internals have changed, entities are converted to
+    datastore.Entity and written with datastore.Put, which is slower but part of the transaction."""
+
+    # datastore.PutAsync only accepts datastore.Entity instances: call the connection directly. It
+    # converts entities with adapter.entity_to_pb
+    connection = _lazy_connection()
+    if connection is None:
+        rpc = datastore.PutAsync([_to_datastore_entity(entity) for entity in entities])
+    else:
+        rpc = connection.async_put(None, entities)
+    keys = rpc.get_result()
+    for entity, key in zip(entities, keys):
+        if isinstance(entity, db.Model) and entity._entity is None:
+            entity._entity = _saved_entity(key)
+    return keys
+
+
+def _saved_entity(key):
+    """Returns a datastore.Entity with key and no properties, for db.Model._entity after a put.
+    db.Model uses it for key() and is_saved(), and sets every property on it before the next
+    db.put, so the properties are never needed."""
+
+    entity_proto = entity_pb.EntityProto()
+    entity_proto.mutable_key().CopyFrom(key._ToPb())
+    entity_proto.mutable_entity_group().add_element().CopyFrom(
+        entity_proto.key().path().element(0))
+    return datastore.Entity.FromPb(entity_proto)
+
+
+def put_async(entities):
+    """Starts writing entities, which are the same as for put, and returns an RPC. Its
+    get_result() returns the keys. Any number of these can be in flight at once. Unlike put, this
+    writes outside of any current transaction (unless the SDK's internals have changed), and does
+    not set the keys of db.Models."""
+
+    connection = _lazy_connection(transactional=False)
+    if connection is None:
+        return datastore.PutAsync([_to_datastore_entity(entity) for entity in entities])
+    return connection.async_put(None, entities)
+
+
+def query(kind, filters=None, batch_size=None, limit=None, model_class=None, compact=False):
+    """Runs a query for entities of kind, and yields a LazyEntity for each result. filters is a
+    dict in the format accepted by datastore.Query, e.g. {'prop_a =': u'value'}. See run_query."""
+
+    return run_query(datastore.Query(kind, filters or {}), batch_size=batch_size, limit=limit,
+        model_class=model_class, compact=compact)
+
+
+def run_query(query, batch_size=None, limit=None, model_class=None, compact=False):
+    """Runs query (a db.Query or datastore.Query), and yields a LazyEntity for each result, as each
+    batch arrives. Compared to a keys-only query followed by get, this saves one datastore round
+    trip per batch, as well as the datastore.Entity conversion of every result. Keys-only queries
+    yield db.Keys as usual. Queries with IN or != filters are not supported, and results are read
+    outside of any current transaction. model_class and compact are the same as for get."""
+
+    if isinstance(query, db.Query):
+        query = query._get_query()
+    if isinstance(query, datastore.MultiQuery):
+        raise Exception("Unsupported query: IN and != filters require multiple queries")
+
+    query_options = query.GetQueryOptions().merge(
+        datastore_query.QueryOptions(batch_size=batch_size, limit=limit))
+    connection = _lazy_connection(model_class, compact, transactional=False)
+    if connection is None:
+        factory = _entity_factory(model_class, compact)
+        batcher = query.GetQuery().run(datastore._GetConnection(), query_options)
+        for batch in batcher:
+            for result in batch.results:
+                if isinstance(result, datastore.Entity):
+                    result = factory(result.ToPb())
+                yield result
+        return
+
+    batcher = query.GetQuery().run(connection, query_options)
+    for batch in batcher:
+        for result in batch.results:
+            yield result
+
+
+def _to_db_keys(keys):
+    return [key.to_old_key() if isinstance(key, ndb.Key) else key for key in keys]
+
+
+def _entity_factory(model_class, compact=False, projection=None):
+    """Returns the function that DatastoreLazyEntityAdapter should use to wrap EntityProtos."""
+
+    if projection is not None:
+        if compact:
+            raise ValueError('compact and projection cannot be used together')
+        decoders = None
+        if model_class is not None:
+            decoders = compile_decoders(model_class)
+        return functools.partial(ProjectedLazyEntity, projection=frozenset(projection),
+            decoders=decoders)
+
+    entity_class = LazyEntity
+    if compact:
+        entity_class = CompactLazyEntity
+    if model_class is None:
+        return entity_class
+    return functools.partial(entity_class, decoders=compile_decoders(model_class))
+
+
+def _lazy_connection(model_class=None, compact=False, projection=None, entity_factory=None,
+        transactional=True):
+    """Returns this thread's datastore_rpc.Connection that converts entities with a
+    DatastoreLazyEntityAdapter, for the entity factory returned by _entity_factory(model_class,
+    compact, projection), or for entity_factory if it is set. The connection is created the first
+    time, with the same adapter and configuration as this thread's datastore connection (except
+    with a projection, which gets a new connection each call, so the cache stays bounded), and is
+    never modified, so any number of its RPCs can be in flight at once, and other datastore calls
+    on this thread are not affected.
+
+    Returns None if the caller should get or put entities the normal way: when the SDK's internals
+    have changed (see _SDK_ERROR), the API version is not datastore v3, or this thread is in a
+    transaction and transactional is True, since the lazy connection is outside the transaction."""
+
+    if _SDK_ERROR is not None:
+        return None
+    base = datastore._GetConnection()
+    if base._api_version != datastore_rpc._DATASTORE_V3:
+        return None
+    if isinstance(base, datastore_rpc.TransactionalConnection):
+        if transactional:
+            return None
+        # transactions are short and have their own configuration: don't replace the cache
+        return _new_lazy_connection(base, model_class, compact, projection, entity_factory)
+    if projection is not None:
+        # projections vary per call: caching them would keep a connection for each one forever
+        return _new_lazy_connection(base, model_class, compact, projection, entity_factory)
+
+    # the thread's connection is replaced by e.g. datastore_rpc configuration changes and tests:
+    # start again if its adapter or configuration is no longer the one the cache was built from
+    cache = getattr(_local, 'connections', None)
+    if (cache is None or _local.base_adapter is not base.adapter
+            or _local.base_config is not base.config):
+        cache = {}
+        _local.connections = cache
+        _local.base_adapter = base.adapter
+        _local.base_config = base.config
+
+    # at most one per model class, compact, and entity_factory (a module-level function)
+    cache_key = (model_class, compact, entity_factory)
+    connection = cache.get(cache_key)
+    if connection is None:
+        connection = _new_lazy_connection(base, model_class, compact, None, entity_factory)
+        cache[cache_key] = connection
+    return connection
+
+
+def _new_lazy_connection(base, model_class, compact, projection, entity_factory):
+    if entity_factory is None:
+        entity_factory = _entity_factory(model_class, compact, projection)
+    return datastore_rpc.Connection(
+        adapter=DatastoreLazyEntityAdapter(base.adapter, entity_factory), config=base.config)
+
+
+def _get_normally(keys, entity_factory):
+    """Gets keys with datastore.Get, which uses this thread's connection, including any
+    transaction, and wraps the entities' EntityProtos with entity_factory."""
+
+    return _entities_to_lazy(datastore.GetAsync(keys).get_result(), entity_factory)
+
+
+def _entities_to_lazy(entities, entity_factory):
+    return [None if entity is None else entity_factory(entity.ToPb()) for entity in entities]
+
+
+def _to_datastore_entity(entity):
+    """Converts anything put accepts to a datastore.Entity."""
+
+    if isinstance(entity, datastore.Entity):
+        return entity
+    return datastore.Entity.FromPb(_to_entity_pb(entity))
+
+
+def _to_entity_pb(entity):
+    """Returns the EntityProto for a LazyEntity, db.Model or EntityProto, or None for anything
+    else."""
+
+    if isinstance(entity, LazyEntity):
+        return entity._to_pb()
+    if isinstance(entity, db.Model):
+        return model_to_pb(entity, auto_update=True)
+    if isinstance(entity, entity_pb.EntityProto):
+        return entity
+    return None
+
+
+def _check_sdk():
+    """Returns None if the SDK has the datastore internals that _lazy_connection uses, or a
+    description of the first one that is missing."""
+
+    for module, names in ((datastore, ('_GetConnection', 'GetAsync', 'PutAsync')),
+            (datastore_rpc, ('Connection', 'TransactionalConnection', '_DATASTORE_V3'))):
+        for name in names:
+            if not hasattr(module, name):
+                return '%s.%s does not exist' % (module.__name__, name)
+    for name in ('adapter', 'config', 'async_get', 'async_put'):
+        if not hasattr(datastore_rpc.Connection, name):
+            return 'datastore_rpc.Connection.%s does not exist' % name
+    # the SDK wraps Connection.__init__ in a decorator, which hides its arguments: try it instead
+    adapter = datastore.DatastoreAdapter()
     try:
-        rpc = datastore.GetAsync(keys)
-        return rpc.get_result()
-    finally:
-        connection._BaseConnection__adapter = real_adapter
+        connection = datastore_rpc.Connection(adapter=adapter,
+            config=datastore_rpc.Configuration())
+    except TypeError, e:
+        return 'datastore_rpc.Connection(adapter=..., config=...) failed: %s' % e
+    if connection.adapter is not adapter:
+        return 'datastore_rpc.Connection does not use the adapter it is given'
+    return None
+
+
+# None if the lazy connection can be used; otherwise why not. Checked once on import, so an SDK
+# upgrade that changes the internals makes datastore_lazy slow instead of broken
+_SDK_ERROR = _check_sdk()
+if _SDK_ERROR is not None:
+    logging.warning('datastore_lazy: %s; entities will be converted normally, which is slower',
+        _SDK_ERROR)
+
+_local = threading.local()
+
+
+def serialize(entity):
+    """Returns the serialized EntityProto for a LazyEntity, including any assigned properties."""
+
+    return entity._to_pb().SerializeToString()
 
 
 class DatastoreLazyEntityAdapter(object):
     '''Wraps an existing datastore_rpc.AbstractAdapter and replaces pb_to_entity with a version
-    that returns LazyEntity instances.'''
+    that returns LazyEntity instances (or whatever entity_factory returns), and entity_to_pb with a
+    version that accepts them, as well as db.Model instances (see model_to_pb) and EntityProtos.'''
 
-    def __init__(self, real_adapter):
+    def __init__(self, real_adapter, entity_factory=None):
         self.__real_adapter = real_adapter
+        self.__entity_factory = entity_factory or LazyEntity
 
     def pb_to_key(self, pb):
         return self.__real_adapter.pb_to_key(pb)
 
     def pb_to_entity(self, pb):
-        return LazyEntity(pb)
+        return self.__entity_factory(pb)
+
+    def pb_to_query_result(self, pb, query_options):
+        if query_options.keys_only:
+            return self.pb_to_key(pb.key())
+        return self.pb_to_entity(pb)
 
     def key_to_pb(self, key):
         return self.__real_adapter.key_to_pb(key)
 
     def entity_to_pb(self, entity):
-        return self.__real_adapter.entity_to_pb(entity)
+        entity_proto = _to_entity_pb(entity)
+        if entity_proto is None:
+            return self.__real_adapter.entity_to_pb(entity)
+        return entity_proto
 
     def pb_to_index(self, pb):
         return self.__real_adapter.pb_to_index(pb)
 
 
+def compile_decoders(model_class):
+    """Returns a dict of datastore property name -> function that converts an entity_pb.Property
+    to the same value as datastore_types.FromPropertyPb, for the properties declared by
+    model_class (a db.Model or ndb.Model subclass). Each function is specialized for the declared
+    property type, so it skips most of FromPropertyPb's checks. If a stored value does not have
+    the expected type, it falls back to FromPropertyPb, so a decoder is never wrong, only slower.
+    Undeclared and unsupported properties have no decoder. The result is cached per class."""
+
+    decoders = _decoders_by_class.get(model_class)
+    if decoders is not None:
+        return decoders
+
+    if issubclass(model_class, db.Model):
+        properties = [(prop.name, prop) for prop in model_class.properties().itervalues()]
+    else:
+        properties = [(prop._name, prop) for prop in model_class._properties.itervalues()]
+
+    decoders = {}
+    for name, prop in properties:
+        if isinstance(prop, db.ListProperty):
+            # LazyEntity applies the decoder to each value of a multiple property
+            decoder = _LIST_ITEM_DECODERS.get(prop.item_type)
+        else:
+            decoder = None
+            for property_class, property_decoder in _PROPERTY_DECODERS:
+                if isinstance(prop, property_class):
+                    decoder = property_decoder
+                    break
+        if decoder is not None:
+            decoders[name] = decoder
+
+    _decoders_by_class[model_class] = decoders
+    return decoders
+
+
+def _decode_string(prop):
+    value = prop.value()
+    if value.has_stringvalue():
+        if not prop.has_meaning():
+            return unicode(value.stringvalue(), 'utf-8')
+        if prop.meaning() == entity_pb.Property.TEXT:
+            return datastore_types.Text(unicode(value.stringvalue(), 'utf-8'))
+    return datastore_types.FromPropertyPb(prop)
+
+
+def _decode_int(prop):
+    value = prop.value()
+    if value.has_int64value() and not prop.has_meaning():
+        return long(value.int64value())
+    return datastore_types.FromPropertyPb(prop)
+
+
+def _decode_float(prop):
+    value = prop.value()
+    if value.has_doublevalue() and not prop.has_meaning():
+        return value.doublevalue()
+    return datastore_types.FromPropertyPb(prop)
+
+
+def _decode_bool(prop):
+    value = prop.value()
+    if value.has_booleanvalue() and not prop.has_meaning():
+        return bool(value.booleanvalue())
+    return datastore_types.FromPropertyPb(prop)
+
+
+# checked in order: subclasses must come before their base classes
+# (ndb.StringProperty is a subclass of ndb.TextProperty)
+_PROPERTY_DECODERS = (
+    (db.StringProperty, _decode_string),
+    (db.TextProperty, _decode_string),
+    (db.IntegerProperty, _decode_int),
+    (db.FloatProperty, _decode_float),
+    (db.BooleanProperty, _decode_bool),
+    (ndb.TextProperty, _decode_string),
+    (ndb.IntegerProperty, _decode_int),
+    (ndb.FloatProperty, _decode_float),
+    (ndb.BooleanProperty, _decode_bool),
+)
+_LIST_ITEM_DECODERS = {
+    # db.StringListProperty
+    basestring: _decode_string,
+    str: _decode_string,
+    unicode: _decode_string,
+    int: _decode_int,
+    long: _decode_int,
+    float: _decode_float,
+    bool: _decode_bool,
+}
+# get_columns returns columns converted by these decoders as arrays
+_ARRAY_TYPECODES = {
+    _decode_int: 'l',
+    _decode_float: 'd',
+}
+_decoders_by_class = {}
+_NO_DECODERS = {}
+
+
+def compile_encoders(model_class):
+    """Returns a list of (property name, function that gets the value to store from a model,
+    function that converts a name and value to entity_pb.Property messages, indexed) for the
+    properties of model_class, a db.Model subclass, sorted by name. Like compile_decoders, the
+    conversion is specialized for the declared property type, falls back to
+    datastore_types.ToPropertyPb for anything else, and is cached per class."""
+
+    encoders = _encoders_by_class.get(model_class)
+    if encoders is not None:
+        return encoders
+
+    encoders = []
+    for prop in sorted(model_class.properties().itervalues(), key=lambda prop: prop.name):
+        encode = datastore_types.ToPropertyPb
+        if not isinstance(prop, db.ListProperty):
+            for property_class, property_encoder in _PROPERTY_ENCODERS:
+                if isinstance(prop, property_class):
+                    encode = property_encoder
+                    break
+        encoders.append((prop.name, prop.get_value_for_datastore, encode, prop.indexed))
+
+    _encoders_by_class[model_class] = encoders
+    return encoders
+
+
+def model_to_pb(model, auto_update=False):
+    """Returns the EntityProto for model, a db.Model instance, like db.model_to_protobuf but
+    without creating a datastore.Entity: the values are converted directly with the encoders from
+    compile_encoders. The properties may be in a different order.
+
+    If auto_update is True, properties that change on every put, like
+    DateTimeProperty(auto_now=True), are updated first, as db.put does. Unlike db.put, the new
+    values are also set on model, so it matches what is written."""
+
+    if auto_update:
+        for prop in _auto_update_properties(type(model)):
+            value = prop.get_updated_value_for_datastore(model)
+            if value is not db.AUTO_UPDATE_UNCHANGED:
+                prop.__set__(model, prop.make_value_from_datastore(value))
+
+    entity_proto = entity_pb.EntityProto()
+    key_proto = entity_proto.mutable_key()
+    group = entity_proto.mutable_entity_group()
+    if model.has_key():
+        key_proto.CopyFrom(model.key()._ToPb())
+        group.add_element().CopyFrom(key_proto.path().element(0))
+    else:
+        # incomplete key: the datastore allocates an id, and the entity group is left empty
+        parent = model.parent_key()
+        if parent is not None:
+            key_proto.CopyFrom(parent._ToPb())
+        else:
+            key_proto.set_app(datastore_types.ResolveAppId(model._app))
+            # db.Model.__init__ stores the namespace as the private __namespace
+            namespace = datastore_types.ResolveNamespace(model._Model__namespace)
+            if namespace:
+                key_proto.set_name_space(namespace)
+        key_proto.mutable_path().add_element().set_type(model.kind())
+
+    for name, get_value, encode, indexed in compile_encoders(type(model)):
+        _add_property_pbs(entity_proto, encode(name, get_value(model)), indexed)
+    if isinstance(model, db.Expando):
+        for name in model.dynamic_properties():
+            _add_property_pbs(entity_proto,
+                datastore_types.ToPropertyPb(name, getattr(model, name)), True)
+    return entity_proto
+
+
+def _auto_update_properties(model_class):
+    """Returns the properties of model_class that override get_updated_value_for_datastore."""
+
+    props = _auto_update_properties_by_class.get(model_class)
+    if props is None:
+        default = db.Property.get_updated_value_for_datastore.im_func
+        props = [prop for prop in model_class.properties().itervalues()
+            if type(prop).get_updated_value_for_datastore.im_func is not default]
+        _auto_update_properties_by_class[model_class] = props
+    return props
+
+
+_auto_update_properties_by_class = {}
+
+
+def _add_property_pbs(entity_proto, props, indexed):
+    if not isinstance(props, list):
+        props = [props]
+    for prop in props:
+        if indexed and prop.meaning() not in _UNINDEXED_MEANINGS:
+            entity_proto.property_list().append(prop)
+        else:
+            entity_proto.raw_property_list().append(prop)
+
+
+def _new_property_pb(name):
+    prop = entity_pb.Property()
+    prop.set_name(name)
+    prop.set_multiple(False)
+    return prop
+
+
+def _encode_string(name, value):
+    if type(value) is unicode:
+        value = value.encode('utf-8')
+    elif type(value) is not str:
+        return datastore_types.ToPropertyPb(name, value)
+    prop = _new_property_pb(name)
+    prop.mutable_value().set_stringvalue(value)
+    return prop
+
+
+def _encode_int(name, value):
+    # not bool, which is a subclass of int
+    if type(value) is not int and type(value) is not long:
+        return datastore_types.ToPropertyPb(name, value)
+    prop = _new_property_pb(name)
+    prop.mutable_value().set_int64value(value)
+    return prop
+
+
+def _encode_float(name, value):
+    if type(value) is not float:
+        return datastore_types.ToPropertyPb(name, value)
+    prop = _new_property_pb(name)
+    prop.mutable_value().set_doublevalue(value)
+    return prop
+
+
+def _encode_bool(name, value):
+    if type(value) is not bool:
+        return datastore_types.ToPropertyPb(name, value)
+    prop = _new_property_pb(name)
+    prop.mutable_value().set_booleanvalue(value)
+    return prop
+
+
+# db.TextProperty values need the TEXT meaning: ToPropertyPb handles them
+_PROPERTY_ENCODERS = (
+    (db.StringProperty, _encode_string),
+    (db.IntegerProperty, _encode_int),
+    (db.FloatProperty, _encode_float),
+    (db.BooleanProperty, _encode_bool),
+)
+_encoders_by_class = {}
+
+
+# values with these meanings can't be indexed: datastore.Entity always writes them as raw properties
+_UNINDEXED_MEANINGS = frozenset((entity_pb.Property.BLOB, entity_pb.Property.TEXT))
+
+
 class LazyEntity(object):
     """Wraps an entity_pb.EntityProto to provide easy access to properties. It caches the
     conversion from property to Python because accessing protocol buffer properties is slower
     than accessing native Python properties (see link in datastore_get_lazy), and because we do
-    a bunch of work to convert to the correct type."""
+    a bunch of work to convert to the correct type.
+
+    Assigning or deleting a property marks it dirty. put re-encodes only the dirty properties into
+    the wrapped EntityProto; the rest are written back exactly as they were read.
+
+    decoders is an optional dict returned by compile_decoders. Properties without a decoder are
+    converted with datastore_types.FromPropertyPb."""
 
-    def __init__(self, entity_proto):
+    def __init__(self, entity_proto, decoders=None):
+        # set first: __setattr__ uses it
+        self.__dirty = set()
+        self.__entity_proto = entity_proto
+        self.__decoders = decoders or _NO_DECODERS
         self.__key = db.Key._FromPb(entity_proto.key())
         self.__properties = {}
         for prop_list in (entity_proto.property_list(), entity_proto.raw_property_list()):
@@ -99,16 +712,607 @@ class LazyEntity(object):
             raise AttributeError("entity for kind '%s' has no attribute '%s'" % (
                 self.__key.kind(), prop_name))
 
+        decode = self.__decoders.get(prop_name, datastore_types.FromPropertyPb)
         if isinstance(prop, list):
-            converted = [datastore_types.FromPropertyPb(p) for p in prop]
+            converted = [decode(p) for p in prop]
         else:
-            converted = datastore_types.FromPropertyPb(prop)
+            converted = decode(prop)
 
-        # store on this object: don't call __getattr__ again
-        setattr(self, prop_name, converted)
+        # store on this object: don't call __getattr__ again. Bypass __setattr__: this is not dirty
+        self.__dict__[prop_name] = converted
         return converted
 
+    def __setattr__(self, name, value):
+        if name.startswith('_LazyEntity__'):
+            object.__setattr__(self, name, value)
+            return
+        self.__dict__[name] = value
+        self.__dirty.add(name)
+
+    def __delattr__(self, name):
+        if name not in self.__dict__ and name not in self.__properties:
+            raise AttributeError("entity for kind '%s' has no attribute '%s'" % (
+                self.__key.kind(), name))
+        self.__dict__.pop(name, None)
+        self.__properties.pop(name, None)
+        self.__dirty.add(name)
+
+    def _to_pb(self):
+        """Returns the wrapped EntityProto after replacing the Property messages of any dirty
+        properties. Used by DatastoreLazyEntityAdapter.entity_to_pb."""
+
+        if not self.__dirty:
+            return self.__entity_proto
+
+        entity_proto = self.__entity_proto
+        unindexed = set()
+        for prop in entity_proto.raw_property_list():
+            if prop.name() in self.__dirty:
+                unindexed.add(prop.name())
+        for prop_list in (entity_proto.property_list(), entity_proto.raw_property_list()):
+            prop_list[:] = [prop for prop in prop_list if prop.name() not in self.__dirty]
+
+        for name in self.__dirty:
+            if name not in self.__dict__:
+                # deleted
+                continue
+            props = datastore_types.ToPropertyPb(name, self.__dict__[name])
+            if not isinstance(props, list):
+                props = [props]
+            for prop in props:
+                if name in unindexed or prop.meaning() in _UNINDEXED_MEANINGS:
+                    entity_proto.raw_property_list().append(prop)
+                else:
+                    entity_proto.property_list().append(prop)
+            # keep __getattr__ consistent with the proto if the cached value is ever dropped
+            if len(props) == 1 and not props[0].multiple():
+                self.__properties[name] = props[0]
+            else:
+                self.__properties[name] = props
+
+        self.__dirty.clear()
+        return entity_proto
+
     @staticmethod
-    def deserialize(protobuf_bytes):
+    def deserialize(protobuf_bytes, model_class=None):
         proto = entity_pb.EntityProto(protobuf_bytes)
+        if model_class is not None:
+            return LazyEntity(proto, compile_decoders(model_class))
         return LazyEntity(proto)
+
+
+class CompactLazyEntity(object):
+    """A read-only LazyEntity that uses less memory, for holding many entities at once. Property
+    names are mapped to slot numbers by a table shared by all entities of the same kind, so each
+    entity only stores a list of Property messages indexed by slot, and a list of converted values
+    allocated on first access. LazyEntity instead stores a dict of Property messages plus an
+    instance dict of converted values. decoders is the same as for LazyEntity, but is shared by the
+    kind: the first non-empty decoders passed for a kind is used for all of its entities."""
+
+    __slots__ = ('_key', '_kind_index', '_props', '_values')
+
+    def __init__(self, entity_proto, decoders=None):
+        self._key = db.Key._FromPb(entity_proto.key())
+        self._kind_index = _get_kind_index(self._key.kind(), decoders)
+        self._values = None
+
+        slots = self._kind_index.slots
+        props = [None] * len(slots)
+        for prop_list in (entity_proto.property_list(), entity_proto.raw_property_list()):
+            for prop in prop_list:
+                name = prop.name()
+                slot = slots.get(name)
+                if slot is None:
+                    slot = self._kind_index.add(name)
+                if slot >= len(props):
+                    props.extend([None] * (slot + 1 - len(props)))
+                if prop.multiple():
+                    current = props[slot]
+                    if current is None:
+                        props[slot] = [prop]
+                    else:
+                        current.append(prop)
+                else:
+                    props[slot] = prop
+        self._props = props
+
+    def key(self):
+        return self._key
+
+    def __getattr__(self, prop_name):
+        kind_index = self._kind_index
+        slot = kind_index.slots.get(prop_name)
+        props = self._props
+        if slot is None or slot >= len(props) or props[slot] is None:
+            raise AttributeError("entity for kind '%s' has no attribute '%s'" % (
+                self._key.kind(), prop_name))
+
+        values = self._values
+        if values is None:
+            values = [_NOT_CONVERTED] * len(props)
+            self._values = values
+        converted = values[slot]
+        if converted is _NOT_CONVERTED:
+            prop = props[slot]
+            decode = kind_index.decoders.get(prop_name, datastore_types.FromPropertyPb)
+            if isinstance(prop, list):
+                converted = [decode(p) for p in prop]
+            else:
+                converted = decode(prop)
+            values[slot] = converted
+        return converted
+
+    @staticmethod
+    def deserialize(protobuf_bytes, model_class=None):
+        proto = entity_pb.EntityProto(protobuf_bytes)
+        if model_class is not None:
+            return CompactLazyEntity(proto, compile_decoders(model_class))
+        return CompactLazyEntity(proto)
+
+
+class _KindIndex(object):
+    """Maps the property names of one kind to slot numbers for CompactLazyEntity."""
+
+    def __init__(self):
+        self.slots = {}
+        self.decoders = _NO_DECODERS
+        self._lock = threading.Lock()
+
+    def add(self, name):
+        """Returns the slot for name, adding it if needed. Slots are never removed or reused."""
+
+        with self._lock:
+            slot = self.slots.get(name)
+            if slot is None:
+                slot = len(self.slots)
+                self.slots[name] = slot
+            return slot
+
+
+def _get_kind_index(kind, decoders):
+    kind_index = _kind_indexes.get(kind)
+    if kind_index is None:
+        # setdefault is atomic: threads that race here get the same index
+        kind_index = _kind_indexes.setdefault(kind, _KindIndex())
+    if decoders and not kind_index.decoders:
+        kind_index.decoders = decoders
+    return kind_index
+
+
+_kind_indexes = {}
+# marks values in CompactLazyEntity._values that have not been converted yet
+_NOT_CONVERTED = object()
+
+
+class UnfetchedPropertyError(AttributeError):
+    """Raised when reading a property of a ProjectedLazyEntity that is not in its projection."""
+
+
+class ProjectedLazyEntity(object):
+    """A read-only lazy entity with only the properties named in projection. The other Property
+    messages and the EntityProto are not referenced, so they can be freed as soon as the get
+    returns. Reading a property that was not fetched raises UnfetchedPropertyError (an
+    AttributeError), instead of silently looking like a missing property; a property in the
+    projection that the entity does not have raises a plain AttributeError, like LazyEntity.
+    decoders is the same as for LazyEntity."""
+
+    __slots__ = ('_key', '_projection', '_decoders', '_props', '_values')
+
+    def __init__(self, entity_proto, projection, decoders=None):
+        self._key = db.Key._FromPb(entity_proto.key())
+        self._projection = projection
+        self._decoders = decoders or _NO_DECODERS
+        self._values = None
+
+        props = {}
+        for prop_list in (entity_proto.property_list(), entity_proto.raw_property_list()):
+            for prop in prop_list:
+                name = prop.name()
+                if name not in projection:
+                    continue
+                if prop.multiple():
+                    props.setdefault(name, []).append(prop)
+                else:
+                    props[name] = prop
+        self._props = props
+
+    def key(self):
+        return self._key
+
+    def __getattr__(self, prop_name):
+        prop = self._props.get(prop_name)
+        if prop is None:
+            if prop_name not in self._projection:
+                raise UnfetchedPropertyError(
+                    "property '%s' of kind '%s' was not fetched; the projection is %s" % (
+                        prop_name, self._key.kind(), sorted(self._projection)))
+            raise AttributeError("entity for kind '%s' has no attribute '%s'" % (
+                self._key.kind(), prop_name))
+
+        values = self._values
+        if values is None:
+            values = {}
+            self._values = values
+        converted = values.get(prop_name, _NOT_CONVERTED)
+        if converted is _NOT_CONVERTED:
+            decode = self._decoders.get(prop_name, datastore_types.FromPropertyPb)
+            if isinstance(prop, list):
+                converted = [decode(p) for p in prop]
+            else:
+                converted = decode(prop)
+            values[prop_name] = converted
+        return converted
+
+
+class RawLazyEntity(object):
+    """Like LazyEntity, but wraps a serialized EntityProto instead of a parsed one. Parsing an
+    EntityProto converts every property, which is slow when the protocol buffer library is pure
+    Python (e.g. the flexible environment). Instead, this scans the wire format once to find where
+    each property starts and ends, and parses a Property only when it is accessed. Construction
+    costs a little per stored property; conversion costs are proportional to the properties used.
+
+    data is the serialized EntityProto, or any object that supports len, indexing and slicing like
+    a str (e.g. buffer or mmap.mmap), with the entity at data[offset:offset+length]. Only offsets
+    are stored, so no bytes are copied until a property is accessed. Read-only: use LazyEntity to
+    modify and put entities."""
+
+    def __init__(self, data, offset=0, length=None, decoders=None):
+        self.__data = data
+        self.__decoders = decoders or _NO_DECODERS
+        self.__key = None
+        self.__key_span = None
+        self.__spans = {}
+
+        if length is None:
+            end = len(data)
+        else:
+            end = offset + length
+        pos = offset
+        while pos < end:
+            tag, pos = _read_varint(data, pos)
+            wire_type = tag & 0x7
+            if wire_type == _WIRETYPE_LENGTH_DELIMITED:
+                size, pos = _read_varint(data, pos)
+                field = tag >> 3
+                if field == _ENTITY_PROPERTY or field == _ENTITY_RAW_PROPERTY:
+                    name, multiple = _scan_property(data, pos, pos + size)
+                    span = (pos, pos + size)
+                    if multiple:
+                        self.__spans.setdefault(name, []).append(span)
+                    else:
+                        self.__spans[name] = span
+                elif field == _ENTITY_KEY:
+                    self.__key_span = (pos, pos + size)
+                pos += size
+            else:
+                pos = _skip_field(data, pos, wire_type)
+        if pos != end:
+            raise ValueError('truncated EntityProto')
+
+    def key(self):
+        if self.__key is None:
+            start, end = self.__key_span
+            self.__key = db.Key._FromPb(entity_pb.Reference(self.__data[start:end]))
+        return self.__key
+
+    def __getattr__(self, prop_name):
+        span = self.__spans.get(prop_name)
+        if not span:
+            raise AttributeError("entity for kind '%s' has no attribute '%s'" % (
+                self.key().kind(), prop_name))
+
+        data = self.__data
+        decode = self.__decoders.get(prop_name, datastore_types.FromPropertyPb)
+        if isinstance(span, list):
+            converted = [decode(entity_pb.Property(data[start:end])) for start, end in span]
+        else:
+            converted = decode(entity_pb.Property(data[span[0]:span[1]]))
+
+        # store on this object: don't call __getattr__ again
+        setattr(self, prop_name, converted)
+        return converted
+
+    @staticmethod
+    def deserialize(protobuf_bytes, model_class=None):
+        if model_class is not None:
+            return RawLazyEntity(protobuf_bytes, decoders=compile_decoders(model_class))
+        return RawLazyEntity(protobuf_bytes)
+
+
+# protocol buffer wire format: see https://developers.google.com/protocol-buffers/docs/encoding
+_WIRETYPE_VARINT = 0
+_WIRETYPE_FIXED64 = 1
+_WIRETYPE_LENGTH_DELIMITED = 2
+_WIRETYPE_FIXED32 = 5
+_ENTITY_KEY = entity_pb.EntityProto.kkey
+_ENTITY_PROPERTY = entity_pb.EntityProto.kproperty
+_ENTITY_RAW_PROPERTY = entity_pb.EntityProto.kraw_property
+_PROPERTY_NAME = entity_pb.Property.kname
+_PROPERTY_MULTIPLE = entity_pb.Property.kmultiple
+
+
+def _read_varint(data, pos):
+    """Returns (value, position after the varint) for the varint at data[pos]."""
+
+    result = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _skip_field(data, pos, wire_type):
+    """Returns the position after the value of a field of wire_type starting at data[pos]."""
+
+    if wire_type == _WIRETYPE_VARINT:
+        return _read_varint(data, pos)[1]
+    if wire_type == _WIRETYPE_LENGTH_DELIMITED:
+        size, pos = _read_varint(data, pos)
+        return pos + size
+    if wire_type == _WIRETYPE_FIXED64:
+        return pos + 8
+    if wire_type == _WIRETYPE_FIXED32:
+        return pos + 4
+    raise ValueError('unsupported wire type %d' % wire_type)
+
+
+def _scan_property(data, pos, end):
+    """Returns (name, multiple) for the serialized Property at data[pos:end]."""
+
+    name = None
+    multiple = None
+    while pos < end:
+        tag, pos = _read_varint(data, pos)
+        field = tag >> 3
+        if field == _PROPERTY_NAME:
+            size, pos = _read_varint(data, pos)
+            name = data[pos:pos + size]
+            pos += size
+        elif field == _PROPERTY_MULTIPLE:
+            value, pos = _read_varint(data, pos)
+            multiple = bool(value)
+        else:
+            pos = _skip_field(data, pos, tag & 0x7)
+        # fields are serialized in field number order, so the value is usually skipped
+        if name is not None and multiple is not None:
+            return name, multiple
+    if name is None:
+        raise ValueError('Property without a name')
+    return name, bool(multiple)
+
+
+class LazyModel(object):
+    """Mixin for db.Model subclasses that converts each property the first time it is read. It must
+    come before the db.Model subclass in the list of base classes, e.g.:
+
+        class LazyModel100(datastore_lazy.LazyModel, Model100):
+            pass
+
+    LazyModel100.get(keys) fetches entities with datastore_lazy.get, and builds each instance
+    around its LazyEntity without converting any properties, skipping both Entity.FromPb and
+    from_entity. db.Property.__get__ reads the instance attribute '_' + name, so __getattr__ fills
+    it in from the LazyEntity when it is missing. Assigning properties and put work as usual.
+    db.get and queries still convert every property: they always create a datastore.Entity, which
+    from_entity then converts eagerly. db.Expando subclasses are not supported."""
+
+    @classmethod
+    def get(cls, keys):
+        """Like db.Model.get, but the returned instances convert properties lazily."""
+
+        keys, multiple = datastore.NormalizeAndTypeCheckKeys(keys)
+        # module-level get
+        entities = get(keys, cls)
+        instances = [None if entity is None else cls.from_entity(entity) for entity in entities]
+        if multiple:
+            return instances
+        return instances[0]
+
+    @classmethod
+    def from_entity(cls, entity):
+        """Like db.Model.from_entity, but also accepts a LazyEntity, CompactLazyEntity or
+        RawLazyEntity, which is converted lazily."""
+
+        if isinstance(entity, datastore.Entity):
+            return super(LazyModel, cls).from_entity(entity)
+        if issubclass(cls, db.Expando):
+            raise TypeError('LazyModel does not support db.Expando: %s' % cls.__name__)
+
+        key = entity.key()
+        if key.kind() != cls.kind():
+            raise db.KindError('Class %s cannot handle kind \'%s\'' % (repr(cls), key.kind()))
+        instance = cls.__new__(cls)
+        # the attributes db.Model.__init__ sets when called with key=key. The namespace is the
+        # private db.Model.__namespace, which _populate_entity reads
+        instance._key = key
+        instance._key_name = None
+        instance._parent = None
+        instance._parent_key = None
+        instance._app = None
+        instance._Model__namespace = key.namespace()
+        # from_entity sets _entity, which makes is_saved() True. A key-only entity is enough: put
+        # sets every property on it, which converts any that were never read
+        instance._entity = _saved_entity(key)
+        instance._lazy_entity = entity
+        return instance
+
+    def __getattr__(self, name):
+        prop = _get_attr_properties(type(self)).get(name)
+        lazy_entity = self.__dict__.get('_lazy_entity')
+        if prop is None or lazy_entity is None:
+            raise AttributeError("'%s' object has no attribute '%s'" % (
+                type(self).__name__, name))
+
+        try:
+            value = getattr(lazy_entity, prop.name)
+        except AttributeError:
+            # not stored: db.Model.__init__ uses the default
+            value = prop.default_value()
+        else:
+            value = prop.make_value_from_datastore(value)
+        # the same attribute db.Property.__set__ sets, so this is only called once
+        self.__dict__[name] = value
+        return value
+
+
+def _get_attr_properties(model_class):
+    """Returns a dict of instance attribute name -> db.Property for model_class."""
+
+    attr_properties = _attr_properties_by_class.get(model_class)
+    if attr_properties is None:
+        attr_properties = {}
+        for prop in model_class.properties().itervalues():
+            attr_properties[prop._attr_name()] = prop
+        _attr_properties_by_class[model_class] = attr_properties
+    return attr_properties
+
+
+_attr_properties_by_class = {}
+
+
+class LazyNdbModel(object):
+    """Mixin for ndb.Model subclasses that deserializes each property the first time it is used.
+    It must come before the ndb.Model subclass in the list of base classes, e.g.:
+
+        class LazyNdbModel100(datastore_lazy.LazyNdbModel, NdbModel100):
+            pass
+
+    ndb converts every EntityProto it reads (from get, queries and memcache) with Model._from_pb,
+    which deserializes every stored property. This overrides _from_pb to keep each property's
+    Property messages in the instance's _values dict, and deserializes them when ndb first looks
+    the property up. The instances are normal ndb models: they work with put, key, hooks and ndb's
+    context cache. Undeclared and structured properties are deserialized immediately, as are
+    projection query results.
+
+    With ndb's default policy, Context.get writes every entity fetched from the datastore back to
+    memcache with _to_pb, which reads every property. Until a property is loaded or assigned, or
+    the key changes, _to_pb returns a copy of the EntityProto the instance was read from instead,
+    so the write-back does not deserialize anything."""
+
+    @classmethod
+    def _from_pb(cls, pb, set_key=True, ent=None, key=None):
+        # mirrors ndb.Model._from_pb
+        if not isinstance(pb, entity_pb.EntityProto):
+            raise TypeError('pb must be a EntityProto; received %r' % pb)
+        if pb.property_size() and pb.property(0).meaning() == entity_pb.Property.INDEX_VALUE:
+            return super(LazyNdbModel, cls)._from_pb(pb, set_key=set_key, ent=ent, key=key)
+
+        if ent is None:
+            ent = cls()
+        # A key passed in overrides a key in the pb.
+        if key is None and pb.key().path().element_size():
+            key = ndb.Key(reference=pb.key())
+        # If set_key is not set, skip a trivial incomplete key.
+        if key is not None and (set_key or key.id() or key.parent()):
+            ent._key = key
+
+        pending = {}
+        for indexed, prop_list in ((True, pb.property_list()), (False, pb.raw_property_list())):
+            for p in prop_list:
+                name = p.name()
+                pbs = pending.get(name)
+                if pbs is not None:
+                    pbs.append(p)
+                elif name in ent._properties:
+                    pending[name] = [p]
+                else:
+                    ent._get_property_for(p, indexed)._deserialize(ent, p)
+        ent._values = _LazyNdbValues(ent._values, ent, pending, pb)
+        return ent
+
+    def _to_pb(self, pb=None, allow_partial=False, set_key=True):
+        values = self._values
+        if (pb is None and isinstance(values, _LazyNdbValues) and values._pb is not None
+                and values._pb_key == self._key):
+            # nothing was loaded or assigned: the EntityProto is still exact. If set_key is False
+            # the key is left in: ndb only does that for memcache, which passes the key back to
+            # _from_pb, and that overrides the key in the pb
+            pb = entity_pb.EntityProto()
+            pb.CopyFrom(values._pb)
+            return pb
+        return super(LazyNdbModel, self)._to_pb(pb, allow_partial=allow_partial, set_key=set_key)
+
+
+class _LazyNdbValues(dict):
+    """The _values dict of a LazyNdbModel instance: name -> deserialized value, like ndb's. ndb
+    Properties read values with _values.get(name) and check for them with name in _values; both
+    first deserialize any pending Property messages for name. Operations on the whole dict
+    deserialize everything first.
+
+    _pb is the EntityProto the entity was read from, until any value is loaded or assigned: a
+    loaded value may be a list that is then changed in place."""
+
+    def __init__(self, values, entity, pending, pb):
+        dict.__init__(self, values)
+        self._entity = entity
+        self._pending = pending
+        self._pb = pb
+        self._pb_key = entity._key
+
+    def _load(self, name):
+        self._pb = None
+        # pop first: Property._deserialize stores the value with _values[name] = value, and
+        # checks name in _values for repeated properties
+        pbs = self._pending.pop(name)
+        prop = self._entity._properties[name]
+        for p in pbs:
+            prop._deserialize(self._entity, p)
+
+    def _load_all(self):
+        for name in self._pending.keys():
+            self._load(name)
+
+    def get(self, name, default=None):
+        if name in self._pending:
+            self._load(name)
+        elif dict.__contains__(self, name):
+            # e.g. an undeclared property's list, which the caller may change in place
+            self._pb = None
+        return dict.get(self, name, default)
+
+    def __getitem__(self, name):
+        self._pb = None
+        return dict.__getitem__(self, name)
+
+    def __missing__(self, name):
+        # called by dict.__getitem__
+        if name not in self._pending:
+            raise KeyError(name)
+        self._load(name)
+        return dict.__getitem__(self, name)
+
+    def __contains__(self, name):
+        return name in self._pending or dict.__contains__(self, name)
+
+    def has_key(self, name):
+        return name in self
+
+    def __setitem__(self, name, value):
+        self._pb = None
+        self._pending.pop(name, None)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        self._pb = None
+        if self._pending.pop(name, None) is not None and not dict.__contains__(self, name):
+            return
+        dict.__delitem__(self, name)
+
+
+def _load_all_first(method_name):
+    method = getattr(dict, method_name)
+
+    def load_all_first(self, *args, **kwargs):
+        self._pb = None
+        self._load_all()
+        return method(self, *args, **kwargs)
+    load_all_first.__name__ = method_name
+    return load_all_first
+
+for _method_name in ('__iter__', '__len__', '__eq__', '__ne__', '__repr__', 'copy', 'items',
+        'iteritems', 'iterkeys', 'itervalues', 'keys', 'pop', 'popitem', 'setdefault', 'update',
+        'values'):
+    setattr(_LazyNdbValues, _method_name, _load_all_first(_method_name))
@@ -0,0 +1,137 @@
+import collections
+import contextlib
+import logging
+import threading
+import urlparse
+
+from google.appengine.api import apiproxy_stub_map
+
+import dsprofile
+
+
+class RequestCost(object):
+    """Datastore work done by one request: RPCs made, entities fetched by gets and queries, bytes
+    in those responses, and the wall-clock time converting them to entities or models (see
+    dsprofile.profile: it is not CPU time)."""
+
+    def __init__(self):
+        self.rpcs = 0
+        self.calls = collections.defaultdict(int)
+        self.entities = 0
+        self.response_bytes = 0
+        self.conversion_seconds = 0.0
+        self.profiler = None
+
+    def add_call(self, call, response):
+        self.rpcs += 1
+        self.calls[call] += 1
+        if call == 'Get':
+            self.entities += sum(1 for result in response.entity_list() if result.has_entity())
+        elif call in ('RunQuery', 'Next'):
+            self.entities += response.result_size()
+        else:
+            return
+        self.response_bytes += response.ByteSize()
+
+    def headers(self):
+        """Returns a list of (name, value) response headers describing the cost so far."""
+
+        conversion_seconds = self.conversion_seconds
+        if self.profiler is not None:
+            conversion_seconds = self.profiler.conversion_time()
+        return [
+            ('X-Datastore-Rpcs', str(self.rpcs)),
+            ('X-Datastore-Entities', str(self.entities)),
+            ('X-Datastore-Bytes', str(self.response_bytes)),
+            ('X-Datastore-Conversion-Wall-Ms', '%.1f' % (conversion_seconds * 1000)),
+        ]
+
+    def summary(self):
+        calls = ', '.join('%s %d' % item for item in sorted(self.calls.iteritems()))
+        return '%d datastore RPCs (%s); %d entities; %d bytes; %.1f ms wall time converting' % (
+            self.rpcs, calls, self.entities, self.response_bytes, self.conversion_seconds * 1000)
+
+
+@contextlib.contextmanager
+def record():
+    """Counts the datastore work done by this thread during the with block, and yields the
+    RequestCost. The conversion time is measured with dsprofile.profile, without the per-property
+    overhead; a dsprofile.profile nested inside the block takes over recording the conversion
+    time until it ends."""
+
+    _install_hook()
+    cost = RequestCost()
+    previous = getattr(_local, 'cost', None)
+    _local.cost = cost
+    profiler = None
+    try:
+        with dsprofile.profile(per_property=False) as profiler:
+            cost.profiler = profiler
+            yield cost
+    finally:
+        if profiler is not None:
+            cost.conversion_seconds = profiler.conversion_time()
+        cost.profiler = None
+        _local.cost = previous
+
+
+class CostMiddleware(object):
+    """WSGI middleware that counts the datastore work for each request, adds it to the response
+    headers (see RequestCost.headers), and logs a summary. The headers only include work done
+    before the application calls start_response; the log includes everything until it returns.
+
+    Requests that fetch at least log_min_entities entities are logged at warning level, to make the
+    "fetched 400 wide entities" requests easy to find.
+
+    If query_param is set, only requests with that query parameter are recorded, e.g. ?dscost=1;
+    other requests are passed straight to app. Recording patches the SDK's conversion functions
+    (see dsprofile.profile), which slows down every request while any request is recorded."""
+
+    def __init__(self, app, add_headers=True, log_min_entities=1000, query_param=None):
+        self.app = app
+        self.add_headers = add_headers
+        self.log_min_entities = log_min_entities
+        self.query_param = query_param
+
+    def __call__(self, environ, start_response):
+        if self.query_param is not None:
+            params = urlparse.parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True)
+            if self.query_param not in params:
+                return self.app(environ, start_response)
+
+        with record() as cost:
+            def cost_start_response(status, response_headers, exc_info=None):
+                if self.add_headers:
+                    response_headers = list(response_headers) + cost.headers()
+                return start_response(status, response_headers, exc_info)
+            result = self.app(environ, cost_start_response)
+
+        if cost.entities >= self.log_min_entities:
+            log = logging.warning
+        else:
+            log = logging.info
+        log('dscost %s %s: %s', environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+            cost.summary())
+        return result
+
+
+_local = threading.local()
+_HOOK_NAME = 'dscost'
+
+
+def _install_hook():
+    # testbed and some test harnesses replace the apiproxy, so this checks every time; Append
+    # ignores a hook that is already installed
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(_HOOK_NAME, _post_call_hook,
+        'datastore_v3')
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    cost = getattr(_local, 'cost', None)
+    if cost is None:
+        return
+    if error is not None:
+        cost.rpcs += 1
+        cost.calls[call] += 1
+        return
+    cost.add_call(call, response)
@@ -0,0 +1,333 @@
+import collections
+import contextlib
+import cProfile
+import functools
+import logging
+import pstats
+import random
+import StringIO
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import model as ndb_model
+
+import datastore_lazy
+
+
+# Stages of getting entities from the datastore. Each call is charged to the innermost stage, so
+# the times are exclusive: pb_to_entity does not include the property_conversion calls it makes.
+RPC_WAIT = 'rpc_wait'
+PB_TO_ENTITY = 'pb_to_entity'
+FROM_ENTITY = 'from_entity'
+PROPERTY_CONVERSION = 'property_conversion'
+# everything else in the profiled block
+OTHER = 'other'
+STAGES = (RPC_WAIT, PB_TO_ENTITY, FROM_ENTITY, PROPERTY_CONVERSION, OTHER)
+
+
+@contextlib.contextmanager
+def profile(cprofile=False, per_property=True):
+    """Records the time this thread spends in each stage of datastore deserialization during the
+    with block, and yields the StageProfiler. Times are wall-clock (time.time()), not CPU time:
+    with threadsafe: true they include time other threads hold the GIL.
+
+    * rpc_wait: blocked waiting for datastore RPCs. In production, the runtime parses the response
+      into EntityProtos before the wait returns, so this includes the protocol buffer parsing.
+    * pb_to_entity: the connection's adapter converting EntityProtos: datastore.Entity.FromPb for
+      db, Model._from_pb for ndb, or creating LazyEntities for datastore_lazy.
+    * from_entity: db.Model.from_entity converting datastore.Entity to models.
+    * property_conversion: datastore_types.FromPropertyPb and ndb Property._deserialize, called
+      for each property value.
+    * other: everything else.
+
+    While any thread has an active profile, these functions are patched to check if a profile is
+    active on the current thread (see install); the originals are restored when the last profile
+    ends. Meanwhile, this costs roughly one thread-local lookup per call on threads that are not
+    profiling, and about a microsecond per call when profiling, which inflates
+    property_conversion for wide entities.
+
+    If cprofile is True, a cProfile.Profile is collected for each stage; see StageProfiler.stats.
+    If per_property is False, property_conversion is not recorded separately: it is charged to
+    the stage that called it, which avoids the overhead per property.
+    Only one profile is active on a thread at a time: a nested profile replaces the outer one
+    until it ends."""
+
+    _acquire()
+    try:
+        profiler = StageProfiler(cprofile, per_property)
+        previous = getattr(_local, 'profiler', None)
+        if previous is not None:
+            previous._pause()
+        _local.profiler = profiler
+        profiler._start()
+        try:
+            yield profiler
+        finally:
+            profiler._stop()
+            _local.profiler = previous
+            if previous is not None:
+                previous._resume()
+    finally:
+        _release()
+
+
+class StageProfiler(object):
+    """The times and calls for each stage recorded by profile()."""
+
+    def __init__(self, cprofile=False, per_property=True):
+        self.per_property = per_property
+        self.times = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.total = 0.0
+        self.__profiles = {}
+        self.__cprofile = cprofile
+        self.__stack = []
+        self.__mark = None
+        self.__start = None
+
+    def _start(self):
+        self.__start = time.time()
+        self.__mark = self.__start
+        self.__enable_profile()
+
+    def _stop(self):
+        now = time.time()
+        self.__disable_profile()
+        self.__charge(now)
+        self.total += now - self.__start
+
+    def _pause(self):
+        self.__disable_profile()
+        self.__charge(time.time())
+
+    def _resume(self):
+        self.__mark = time.time()
+        self.__enable_profile()
+
+    def _enter(self, stage):
+        now = time.time()
+        self.__disable_profile()
+        self.__charge(now)
+        self.__stack.append(stage)
+        self.calls[stage] += 1
+        self.__enable_profile()
+        self.__mark = time.time()
+
+    def _exit(self):
+        now = time.time()
+        self.__disable_profile()
+        self.__charge(now)
+        self.__stack.pop()
+        self.__enable_profile()
+        self.__mark = time.time()
+
+    def __current_stage(self):
+        if self.__stack:
+            return self.__stack[-1]
+        return OTHER
+
+    def __charge(self, now):
+        self.times[self.__current_stage()] += now - self.__mark
+        self.__mark = now
+
+    def __enable_profile(self):
+        if self.__cprofile:
+            stage = self.__current_stage()
+            profile = self.__profiles.get(stage)
+            if profile is None:
+                profile = cProfile.Profile()
+                self.__profiles[stage] = profile
+            profile.enable()
+
+    def __disable_profile(self):
+        if self.__cprofile:
+            self.__profiles[self.__current_stage()].disable()
+
+    def stats(self, stage):
+        """Returns a pstats.Stats for stage, or None if it was not profiled with cprofile=True or
+        never ran."""
+
+        profile = self.__profiles.get(stage)
+        if profile is None:
+            return None
+        return pstats.Stats(profile, stream=StringIO.StringIO())
+
+    def format_stats(self, stage, sort='cumulative', limit=20):
+        """Returns the text of the cProfile report for stage."""
+
+        stats = self.stats(stage)
+        if stats is None:
+            return ''
+        stats.stream = StringIO.StringIO()
+        stats.sort_stats(sort).print_stats(limit)
+        return stats.stream.getvalue()
+
+    def conversion_time(self):
+        """Returns the wall-clock seconds spent converting EntityProtos to entities or models, in
+        any stage."""
+
+        return sum(self.times.get(stage, 0.0)
+            for stage in (PB_TO_ENTITY, FROM_ENTITY, PROPERTY_CONVERSION))
+
+    def summary(self):
+        """Returns a one line summary of the time in each stage."""
+
+        parts = ['total %.1f ms' % (self.total * 1000)]
+        for stage in STAGES:
+            if stage in self.times:
+                part = '%s %.1f ms' % (stage, self.times[stage] * 1000)
+                if stage != OTHER:
+                    part += ' (%d calls)' % self.calls[stage]
+                parts.append(part)
+        return '; '.join(parts)
+
+
+class ProfileMiddleware(object):
+    """WSGI middleware that profiles a random sample of requests, and logs the summary for each one.
+    For example, to profile 1% of requests:
+
+        app = dsprofile.ProfileMiddleware(app, 0.01)
+
+    Only the time until the application returns is profiled; streamed responses are not."""
+
+    def __init__(self, app, sample_rate=0.01, cprofile=False):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.cprofile = cprofile
+
+    def __call__(self, environ, start_response):
+        if random.random() >= self.sample_rate:
+            return self.app(environ, start_response)
+
+        with profile(self.cprofile) as profiler:
+            result = self.app(environ, start_response)
+        logging.info('dsprofile %s %s: %s', environ.get('REQUEST_METHOD'),
+            environ.get('PATH_INFO'), profiler.summary())
+        if self.cprofile:
+            for stage in STAGES:
+                report = profiler.format_stats(stage)
+                if report:
+                    logging.info('dsprofile %s cProfile:\n%s', stage, report)
+        return result
+
+
+_local = threading.local()
+_install_lock = threading.Lock()
+# profiles active on all threads: the functions are patched while this is not 0
+_active_profiles = 0
+# True if install was called: the functions stay patched until uninstall
+_installed_explicitly = False
+# (owner, attribute name, original, replacement) for each patched function, while patched
+_patches = []
+_MISSING = object()
+
+
+def install():
+    """Patches the functions for each stage until uninstall is called, instead of only while a
+    profile is active. Safe to call more than once."""
+
+    global _installed_explicitly
+    with _install_lock:
+        _installed_explicitly = True
+        _patch_all()
+
+
+def uninstall():
+    """Restores the original functions, once no profile is active. Undoes install."""
+
+    global _installed_explicitly
+    with _install_lock:
+        _installed_explicitly = False
+        if _active_profiles == 0:
+            _unpatch_all()
+
+
+def _acquire():
+    global _active_profiles
+    with _install_lock:
+        _active_profiles += 1
+        _patch_all()
+
+
+def _release():
+    global _active_profiles
+    with _install_lock:
+        _active_profiles -= 1
+        if _active_profiles == 0 and not _installed_explicitly:
+            _unpatch_all()
+
+
+def _patch_all():
+    if _patches:
+        return
+
+    original_wait = apiproxy_stub_map.UserRPC.wait
+    @functools.wraps(original_wait)
+    def wait(rpc):
+        if rpc.service != 'datastore_v3':
+            return original_wait(rpc)
+        return _call_in_stage(RPC_WAIT, original_wait, rpc)
+    _patch(apiproxy_stub_map.UserRPC, 'wait', wait)
+
+    for adapter_class in (datastore.DatastoreAdapter, ndb_model.ModelAdapter,
+            datastore_lazy.DatastoreLazyEntityAdapter):
+        _patch(adapter_class, 'pb_to_entity',
+            _timed(PB_TO_ENTITY, adapter_class.pb_to_entity.im_func))
+
+    _patch(db.Model, 'from_entity',
+        classmethod(_timed(FROM_ENTITY, db.Model.from_entity.im_func)))
+
+    _patch(datastore_types, 'FromPropertyPb',
+        _timed(PROPERTY_CONVERSION, datastore_types.FromPropertyPb))
+    _patch(ndb.Property, '_deserialize',
+        _timed(PROPERTY_CONVERSION, ndb.Property._deserialize.im_func))
+
+
+def _patch(owner, name, replacement):
+    _patches.append((owner, name, vars(owner).get(name, _MISSING), replacement))
+    setattr(owner, name, replacement)
+
+
+def _unpatch_all():
+    while _patches:
+        owner, name, original, replacement = _patches.pop()
+        # leave alone anything that was patched again since
+        if vars(owner).get(name) is not replacement:
+            continue
+        if original is _MISSING:
+            delattr(owner, name)
+        else:
+            setattr(owner, name, original)
+
+
+def _timed(stage, func):
+    """Returns a wrapper for func that charges its calls to stage, when profiling."""
+
+    if stage == PROPERTY_CONVERSION:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = getattr(_local, 'profiler', None)
+            if profiler is None or not profiler.per_property:
+                return func(*args, **kwargs)
+            return _call_in_stage(stage, func, *args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return _call_in_stage(stage, func, *args, **kwargs)
+    return wrapper
+
+
+def _call_in_stage(stage, func, *args, **kwargs):
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        return func(*args, **kwargs)
+    profiler._enter(stage)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler._exit()
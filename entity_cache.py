@@ -0,0 +1,231 @@
+import collections
+import threading
+
+from google.appengine.api import memcache
+
+import datastore_lazy
+
+DEFAULT_MAX_BYTES = 8 << 20
+# prefix for memcache keys: the rest is str(db.Key)
+MEMCACHE_KEY_PREFIX = 'entity_cache:'
+# seconds entities stay in memcache, which bounds how stale they can get if an invalidate is lost
+DEFAULT_MEMCACHE_SECONDS = 3600
+# the memcache value for a key that a get is filling from the datastore, and for how many seconds;
+# the same scheme as ndb
+_LOCKED = 0
+_LOCK_SECONDS = 32
+
+
+class EntityCache(object):
+    """A process-local least recently used cache of serialized entities (EntityProto bytes), keyed
+    by db.Key. Storing bytes instead of objects keeps the size bounded and predictable, and
+    reading an entity back only costs a RawLazyEntity, which converts properties when they are
+    accessed. Holds at most max_bytes of serialized entities. Safe to use from multiple threads.
+
+    hits, misses and evictions count get_serialized calls that found an entity, calls that did
+    not, and entities removed to make space."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        # key -> serialized entity, least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_serialized(self, key):
+        """Returns the serialized entity for key, or None if it is not cached."""
+
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            # re-insert to mark it most recently used
+            self._entries[key] = data
+            self.hits += 1
+            return data
+
+    def put_serialized(self, key, data):
+        """Caches the serialized entity data for key, evicting the least recently used entities
+        if needed. Entities larger than max_bytes are not cached."""
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            if len(data) > self.max_bytes:
+                return
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        """Removes the entities for keys. Call this after writing them."""
+
+        with self._lock:
+            for key in keys:
+                data = self._entries.pop(key, None)
+                if data is not None:
+                    self._bytes -= len(data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def size_bytes(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entities': len(self._entries),
+            'bytes': self._bytes,
+        }
+
+
+class GetStats(object):
+    """Counts where get found entities. Pass the same instance to every get in a request to report
+    the round trips saved by that request."""
+
+    def __init__(self):
+        self.local_hits = 0
+        self.memcache_hits = 0
+        self.datastore_entities = 0
+        self.memcache_round_trips = 0
+        self.datastore_round_trips = 0
+        # get calls that needed no datastore round trip
+        self.datastore_round_trips_saved = 0
+
+    def summary(self):
+        return ('entity_cache: %d local hits, %d memcache hits, %d datastore entities; '
+            '%d memcache and %d datastore round trips; %d datastore round trips saved') % (
+            self.local_hits, self.memcache_hits, self.datastore_entities,
+            self.memcache_round_trips, self.datastore_round_trips,
+            self.datastore_round_trips_saved)
+
+
+default_cache = EntityCache()
+
+
+def get(keys, model_class=None, cache=None, use_memcache=False, stats=None,
+        memcache_seconds=DEFAULT_MEMCACHE_SECONDS):
+    """Like datastore_lazy.get, but returns cached entities from cache (default_cache if None) as
+    RawLazyEntity instances, and only fetches the rest from the datastore, caching them. keys must
+    be db.Keys. This does not see writes made by other instances or by code that does not call
+    invalidate: only use it for data that can be slightly stale.
+
+    If use_memcache is True, entities missing from cache are looked up in memcache with one
+    get_multi before going to the datastore, and entities read from the datastore are added to
+    memcache for memcache_seconds. Memcache also stores serialized EntityProtos, so hits are never
+    converted to datastore.Entity. Like ndb, each missing key is locked in memcache before the
+    datastore read, and the entity replaces the lock with a compare-and-set, so an invalidate
+    between the read and the write to memcache stops the old entity being cached. If stats is a
+    GetStats, the counts for this call are added to it."""
+
+    if cache is None:
+        cache = default_cache
+    if stats is None:
+        stats = GetStats()
+
+    results = [None] * len(keys)
+    missing_keys = []
+    missing_indexes = []
+    for i, key in enumerate(keys):
+        data = cache.get_serialized(key)
+        if data is None:
+            missing_keys.append(key)
+            missing_indexes.append(i)
+        else:
+            results[i] = datastore_lazy.RawLazyEntity.deserialize(data, model_class)
+    stats.local_hits += len(keys) - len(missing_keys)
+
+    # memcache keys this call locked, which it may fill from the datastore
+    locked_keys = set()
+    if missing_keys and use_memcache:
+        # the client remembers the compare-and-set ids, so it can't be shared between threads
+        client = memcache.Client()
+        memcache_keys = [str(key) for key in missing_keys]
+        found = client.get_multi(memcache_keys, key_prefix=MEMCACHE_KEY_PREFIX)
+        stats.memcache_round_trips += 1
+
+        still_missing_keys = []
+        still_missing_indexes = []
+        unlocked_keys = []
+        for key, memcache_key, i in zip(missing_keys, memcache_keys, missing_indexes):
+            data = found.get(memcache_key)
+            if isinstance(data, str):
+                stats.memcache_hits += 1
+                cache.put_serialized(key, data)
+                results[i] = datastore_lazy.RawLazyEntity.deserialize(data, model_class)
+                continue
+            still_missing_keys.append(key)
+            still_missing_indexes.append(i)
+            if data is None:
+                unlocked_keys.append(memcache_key)
+        missing_keys = still_missing_keys
+        missing_indexes = still_missing_indexes
+
+        if unlocked_keys:
+            client.add_multi(dict((key, _LOCKED) for key in unlocked_keys),
+                key_prefix=MEMCACHE_KEY_PREFIX, time=_LOCK_SECONDS)
+            # another get may have added its lock first: either can fill it
+            locks = client.get_multi(unlocked_keys, key_prefix=MEMCACHE_KEY_PREFIX, for_cas=True)
+            stats.memcache_round_trips += 2
+            locked_keys = set(key for key, value in locks.iteritems() if value == _LOCKED)
+
+    if not missing_keys:
+        if keys:
+            stats.datastore_round_trips_saved += 1
+        return results
+
+    entities = datastore_lazy.get(missing_keys, model_class)
+    stats.datastore_round_trips += 1
+    stats.datastore_entities += len(missing_keys)
+    memcache_mapping = {}
+    for i, entity in zip(missing_indexes, entities):
+        results[i] = entity
+        if entity is not None:
+            data = datastore_lazy.serialize(entity)
+            cache.put_serialized(entity.key(), data)
+            memcache_key = str(entity.key())
+            if memcache_key in locked_keys and len(data) <= memcache.MAX_VALUE_SIZE:
+                memcache_mapping[memcache_key] = data
+    # locks for missing entities and values that are too big expire by themselves
+    if memcache_mapping:
+        client.cas_multi(memcache_mapping, key_prefix=MEMCACHE_KEY_PREFIX, time=memcache_seconds)
+        stats.memcache_round_trips += 1
+    return results
+
+
+def put(entities, cache=None, use_memcache=False):
+    """Writes LazyEntities with datastore_lazy.put, then invalidates them in cache (default_cache
+    if None), and in memcache if use_memcache is True. Returns their keys."""
+
+    keys = datastore_lazy.put(entities)
+    invalidate(keys, cache, use_memcache)
+    return keys
+
+
+def invalidate(keys, cache=None, use_memcache=False):
+    """Removes keys from cache (default_cache if None), and from memcache if use_memcache is True.
+    Call this after writing entities any other way, e.g. with db.put. Other instances still have
+    the old entities in their local caches. Deleting from memcache also removes the locks of gets
+    in progress, so they do not cache what they read before the write."""
+
+    if cache is None:
+        cache = default_cache
+    cache.invalidate(keys)
+    if use_memcache:
+        memcache.delete_multi([str(key) for key in keys], key_prefix=MEMCACHE_KEY_PREFIX)
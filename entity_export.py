@@ -0,0 +1,167 @@
+import json
+import mmap
+import struct
+import zlib
+
+import datastore_lazy
+
+# File format:
+# * MAGIC
+# * records: each is the varint length of a serialized EntityProto followed by its bytes. If the
+#   file is compressed, the records are grouped into chunks, each written as the varint length of
+#   the compressed chunk followed by the zlib compressed records.
+# * the footer: JSON with the kind, number of entities, compression, and a dictionary of property
+#   name -> number of entities with the property
+# * the offset of the footer, as 8 little-endian bytes
+MAGIC = 'DSLAZYX1'
+_FOOTER_OFFSET = struct.Struct('<Q')
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def export_kind(kind, path, filters=None, compress=False, batch_size=500):
+    """Writes all entities of kind (optionally matching filters, as for datastore_lazy.query) to
+    path, streaming one query batch at a time. The entities are never converted to datastore.Entity
+    or models: the EntityProtos are serialized as returned by the datastore. Returns the number of
+    entities written."""
+
+    with open(path, 'wb') as f:
+        writer = ExportWriter(f, kind, compress)
+        for entity in datastore_lazy.query(kind, filters, batch_size=batch_size):
+            writer.write_proto(entity._to_pb())
+        writer.close()
+    return writer.count
+
+
+class ExportWriter(object):
+    """Writes serialized EntityProtos of one kind to the file object f in the export format. If
+    compress is True, records are compressed with zlib in chunks of about chunk_size bytes. close
+    must be called to write the footer; it does not close f."""
+
+    def __init__(self, f, kind, compress=False, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.kind = kind
+        self.count = 0
+        self.property_counts = {}
+        self.__f = f
+        self.__compress = compress
+        self.__chunk_size = chunk_size
+        self.__chunk = []
+        self.__chunk_bytes = 0
+        f.write(MAGIC)
+
+    def write_proto(self, entity_proto):
+        names = set(prop.name() for prop in entity_proto.property_list())
+        names.update(prop.name() for prop in entity_proto.raw_property_list())
+        self.write(entity_proto.SerializeToString(), names)
+
+    def write(self, serialized, property_names):
+        """Writes one serialized EntityProto, with the names of its properties."""
+
+        record = _encode_varint(len(serialized)) + serialized
+        for name in property_names:
+            self.property_counts[name] = self.property_counts.get(name, 0) + 1
+        self.count += 1
+
+        if not self.__compress:
+            self.__f.write(record)
+            return
+        self.__chunk.append(record)
+        self.__chunk_bytes += len(record)
+        if self.__chunk_bytes >= self.__chunk_size:
+            self.__flush_chunk()
+
+    def __flush_chunk(self):
+        if not self.__chunk:
+            return
+        compressed = zlib.compress(''.join(self.__chunk))
+        self.__f.write(_encode_varint(len(compressed)))
+        self.__f.write(compressed)
+        self.__chunk = []
+        self.__chunk_bytes = 0
+
+    def close(self):
+        self.__flush_chunk()
+        footer_offset = self.__f.tell()
+        footer = {
+            'kind': self.kind,
+            'count': self.count,
+            'compression': 'zlib' if self.__compress else None,
+            'properties': self.property_counts,
+        }
+        self.__f.write(json.dumps(footer, sort_keys=True))
+        self.__f.write(_FOOTER_OFFSET.pack(footer_offset))
+
+
+class ExportReader(object):
+    """Reads a file written by export_kind or ExportWriter. The file is memory-mapped: iterating
+    yields a RawLazyEntity for each entity, which refers to its bytes in the mapping without
+    copying them, and parses properties when they are accessed. Compressed files are decompressed
+    one chunk at a time, and the entities refer to the decompressed chunk instead. Properties of
+    uncompressed entities can't be read after close(). model_class is the same as for
+    datastore_lazy.get.
+
+    kind, count and property_counts are read from the footer."""
+
+    def __init__(self, path, model_class=None):
+        self.__decoders = None
+        if model_class is not None:
+            self.__decoders = datastore_lazy.compile_decoders(model_class)
+        with open(path, 'rb') as f:
+            self.__data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        data = self.__data
+        try:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError('%s is not an entity export file' % path)
+            footer_end = len(data) - _FOOTER_OFFSET.size
+            self.__footer_offset, = _FOOTER_OFFSET.unpack(data[footer_end:])
+            footer = json.loads(data[self.__footer_offset:footer_end])
+        except:
+            data.close()
+            raise
+        self.kind = footer['kind']
+        self.count = footer['count']
+        self.compression = footer['compression']
+        self.property_counts = footer['properties']
+
+    def __iter__(self):
+        if self.compression is None:
+            return self.__records(self.__data, len(MAGIC), self.__footer_offset)
+        return self.__compressed_records()
+
+    def __records(self, data, pos, end):
+        decoders = self.__decoders
+        while pos < end:
+            length, pos = datastore_lazy._read_varint(data, pos)
+            yield datastore_lazy.RawLazyEntity(data, pos, length, decoders)
+            pos += length
+
+    def __compressed_records(self):
+        data = self.__data
+        pos = len(MAGIC)
+        while pos < self.__footer_offset:
+            length, pos = datastore_lazy._read_varint(data, pos)
+            chunk = zlib.decompress(data[pos:pos + length])
+            pos += length
+            for entity in self.__records(chunk, 0, len(chunk)):
+                yield entity
+
+    def close(self):
+        self.__data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _encode_varint(value):
+    out = []
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(chr(bits | 0x80))
+        else:
+            out.append(chr(bits))
+            return ''.join(out)
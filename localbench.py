@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+import argparse
+import sys
+import time
+
+from google.appengine.api import datastore
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import benchstats
+import bulkload
+import datastore_lazy
+import modelgen
+import perf
+
+
+def setup_testbed():
+    """Activates a testbed with in-memory datastore and memcache stubs, and returns it."""
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # queries must see the seeded entities immediately
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    return bed
+
+
+def seed(model_classes, num_instances, random_seed=0):
+    """Puts num_instances random entities of each of model_classes. The same random_seed always
+    puts the same entities."""
+
+    bulkload.load(bulkload.generate_protos(model_classes, num_instances, random_seed),
+        report_seconds=None)
+
+
+def time_function(func, warmup, repetitions):
+    """Calls func warmup times, then returns a list of the times for repetitions more calls."""
+
+    for _ in xrange(warmup):
+        func()
+    timings = []
+    for _ in xrange(repetitions):
+        start = time.time()
+        func()
+        end = time.time()
+        timings.append(end - start)
+    return timings
+
+
+def run_scenario(name, func, args):
+    # entities cached by ndb's context would skip deserialization
+    ndb.get_context().clear_cache()
+    timings = time_function(func, args.warmup, args.repetitions)
+    print benchstats.format_summary(name, benchstats.summarize(timings))
+    return timings
+
+
+def run_benchmarks(model_classes, args):
+    """Runs the scenarios for model_classes, and returns a list of benchstats records."""
+
+    records = []
+    for model_class in model_classes:
+        print
+        print '## %s:' % model_class.__name__
+        keys = perf.find_keys(model_class, args.entities)
+        scenarios = perf.get_scenarios(model_class, keys)
+        scenarios += perf.query_scenarios(model_class, args.entities)
+        for name, func in scenarios:
+            timings = run_scenario('%d entities: %s' % (len(keys), name), func, args)
+            perf.add_record(records, name, model_class, len(keys), timings)
+
+        # the serialization scenarios read prop_a etc.: only the perf.py models have them
+        if (args.serialization and issubclass(model_class, db.Model) and
+                model_class in perf.MODEL_CLASSES):
+            print
+            instance = model_class.all().get()
+            for _, name, func in perf.serialization_scenarios(instance):
+                timings = run_scenario(name, func, args)
+                perf.add_record(records, name, model_class, 1, timings)
+    return records
+
+
+# string properties longer than this are not allowed, so larger values are text properties
+MAX_STRING_SIZE = 1500
+def sweep_model_classes(property_count, value_size):
+    """Returns (db model class, ndb model class) with property_count properties, each with values
+    of value_size characters."""
+
+    property_type = 'string' if value_size <= MAX_STRING_SIZE else 'text'
+    specs = [modelgen.PropertySpec(property_type, property_count, size=value_size)]
+    suffix = '%dx%d' % (property_count, value_size)
+    return (modelgen.model_class('SweepModel' + suffix, specs),
+        modelgen.model_class('NdbSweepModel' + suffix, specs, ndb_model=True))
+
+
+def sweep_scenarios(db_keys, ndb_keys):
+    """Returns (name, function, model class index) for the paths compared by the sweep."""
+
+    return [
+        ('db.get', lambda: db.get(db_keys), 0),
+        ('ndb.get_multi', lambda: perf.ndb_get_multi_nocache(ndb_keys), 1),
+        ('datastore.GetAsync', lambda: datastore.GetAsync(db_keys).get_result(), 0),
+        ('datastore_lazy.get', lambda: datastore_lazy.get(db_keys), 0),
+    ]
+
+
+def run_sweep(args):
+    """Times each sweep scenario for every combination of property count, batch size and value
+    size, printing the median time per entity and per property so it is easy to see where the
+    cost stops growing linearly. Returns a list of benchstats records."""
+
+    records = []
+    max_batch_size = max(args.batch_sizes)
+    print '%10s %10s %10s  %-20s %10s %12s %12s' % ('properties', 'value size', 'entities',
+        'scenario', 'median ms', 'us/entity', 'us/property')
+    for property_count in args.property_counts:
+        for value_size in args.value_sizes:
+            model_classes = sweep_model_classes(property_count, value_size)
+            seed(model_classes, max_batch_size, args.seed)
+            all_db_keys = perf.find_keys(model_classes[0], max_batch_size)
+            all_ndb_keys = perf.find_keys(model_classes[1], max_batch_size)
+
+            for batch_size in args.batch_sizes:
+                scenarios = sweep_scenarios(all_db_keys[:batch_size], all_ndb_keys[:batch_size])
+                for name, func, class_index in scenarios:
+                    ndb.get_context().clear_cache()
+                    timings = time_function(func, args.warmup, args.repetitions)
+                    median = benchstats.summarize(timings)['median']
+                    print '%10d %10d %10d  %-20s %10.3f %12.1f %12.3f' % (
+                        property_count, value_size, batch_size, name, median * 1000,
+                        median * 1e6 / batch_size, median * 1e6 / (batch_size * property_count))
+                    perf.add_record(records, name, model_classes[class_index], batch_size,
+                        timings)
+    return records
+
+
+def run_concurrency(model_classes, args):
+    """Runs perf.bench_concurrency for model_classes, and returns the total number of errors."""
+
+    errors = 0
+    for model_class in model_classes:
+        print
+        print '## %s:' % model_class.__name__
+        keys = perf.find_keys(model_class, args.entities)
+        errors += perf.bench_concurrency(sys.stdout, model_class, keys, args.concurrency,
+            args.repetitions)
+    return errors
+
+
+def compare_to_baseline(path, records):
+    """Prints the comparison of records with the records in path. Returns True if any scenario
+    is significantly slower."""
+
+    print
+    print '## Compared to %s:' % path
+    regressed = False
+    for comparison in benchstats.compare(benchstats.load_json(path), records):
+        print benchstats.format_comparison(comparison)
+        regressed = regressed or comparison['regression']
+    return regressed
+
+
+def parse_int_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Runs the perf.py benchmarks in-process against the datastore stub')
+    parser.add_argument('--entities', type=int, default=perf.NUM_INSTANCES_TO_DESERIALIZE,
+        help='entities to get per iteration (default %(default)s)')
+    parser.add_argument('--warmup', type=int, default=5,
+        help='untimed iterations before each scenario (default %(default)s)')
+    parser.add_argument('--repetitions', type=int, default=100,
+        help='timed iterations of each scenario (default %(default)s)')
+    parser.add_argument('--no-serialization', dest='serialization', action='store_false',
+        help='skip the serialization scenarios')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed for the generated entities (default %(default)s)')
+    parser.add_argument('--json', metavar='PATH',
+        help='also write the results as JSON records to PATH')
+    parser.add_argument('--baseline', metavar='PATH',
+        help='compare with the JSON results in PATH; exits with status 1 on a regression')
+    parser.add_argument('--schema', type=modelgen.parse_schema,
+        help='benchmark db and ndb models generated from a modelgen schema instead, e.g. '
+            '"string*10:indexed,int*5,text*2:size=1000-5000,key*3:repeated:length=0-10"')
+    parser.add_argument('--concurrency', type=parse_int_list, metavar='N,...',
+        help='instead of the perf.py scenarios, run gets from each number of threads at once, '
+            'e.g. 1,2,4,8; exits with status 1 if any thread gets wrong results')
+    parser.add_argument('--sweep', action='store_true',
+        help='instead of the perf.py scenarios, time gets over every combination of '
+            '--property-counts, --batch-sizes and --value-sizes')
+    parser.add_argument('--property-counts', type=parse_int_list, default=[1, 10, 100, 1000],
+        metavar='N,...', help='sweep: properties per entity (default 1,10,100,1000)')
+    parser.add_argument('--batch-sizes', type=parse_int_list, default=[1, 20, 100],
+        metavar='N,...', help='sweep: entities per get (default 1,20,100)')
+    parser.add_argument('--value-sizes', type=parse_int_list, default=[20, 200],
+        metavar='N,...', help='sweep: characters per property value (default 20,200)')
+    parser.add_argument('models', nargs='*', metavar='MODEL',
+        help='model classes to benchmark (default: all of perf.MODEL_CLASSES)')
+    return parser.parse_args()
+
+
+def select_model_classes(names):
+    if not names:
+        return perf.MODEL_CLASSES
+    by_name = dict((model_class.__name__, model_class) for model_class in perf.MODEL_CLASSES)
+    return [by_name[name] for name in names]
+
+
+def main():
+    args = parse_args()
+    if args.sweep:
+        model_classes = []
+    elif args.schema:
+        model_classes = [
+            modelgen.model_class('SchemaModel', args.schema),
+            modelgen.model_class('NdbSchemaModel', args.schema, ndb_model=True),
+        ]
+    else:
+        model_classes = select_model_classes(args.models)
+
+    bed = setup_testbed()
+    try:
+        errors = 0
+        if args.concurrency:
+            seed(model_classes, args.entities, args.seed)
+            records = []
+            errors = run_concurrency(model_classes, args)
+        elif args.sweep:
+            records = run_sweep(args)
+        else:
+            seed(model_classes, args.entities, args.seed)
+            records = run_benchmarks(model_classes, args)
+    finally:
+        bed.deactivate()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            benchstats.write_json(records, f)
+    if errors:
+        print '%d concurrent gets returned wrong results' % errors
+        sys.exit(1)
+    if args.baseline and compare_to_baseline(args.baseline, records):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
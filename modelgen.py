@@ -1,10 +1,18 @@
 #!/usr/bin/python
 
+import datetime
 import random
 
+from google.appengine.api import datastore_types
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
+from google.appengine.ext import ndb
 
 DB_IMPORT = "from google.appengine.ext import db"
+SCHEMA_IMPORTS = """import datetime
+
+from google.appengine.ext import db
+from google.appengine.ext import ndb"""
 
 LETTERS_START = ord('a')
 LETTERS_END = ord('z') + 1
@@ -36,27 +44,347 @@ def code(num_properties):
 
 
 STRING_LENGTH = 20
-def random_string():
-    out = ""
-    for i in xrange(STRING_LENGTH):
-        out += random.choice(LETTERS)
+def random_string(length=STRING_LENGTH):
+    return random_letters(random, length)
+
+
+# maps each byte to a letter; a..v are slightly more likely than w..z, which doesn't matter here
+_LETTER_TABLE = ''.join(LETTERS[i % BASE] for i in xrange(256))
+def random_letters(rng, length):
+    """Returns length random letters from rng (a random.Random or the random module), generated
+    as one big random number and translated to letters in one step."""
+
+    if length == 0:
+        return ''
+    random_bytes = ('%0*x' % (2 * length, rng.getrandbits(8 * length))).decode('hex')
+    return random_bytes.translate(_LETTER_TABLE)
+
+
+# property types in a schema: each has a very different cost to convert from protocol buffers
+# type -> (db property, db list item type, ndb property)
+PROPERTY_TYPES = {
+    'string': ('db.StringProperty', 'basestring', 'ndb.StringProperty'),
+    'text': ('db.TextProperty', 'db.Text', 'ndb.TextProperty'),
+    'int': ('db.IntegerProperty', 'int', 'ndb.IntegerProperty'),
+    'float': ('db.FloatProperty', 'float', 'ndb.FloatProperty'),
+    'bool': ('db.BooleanProperty', 'bool', 'ndb.BooleanProperty'),
+    'datetime': ('db.DateTimeProperty', 'datetime.datetime', 'ndb.DateTimeProperty'),
+    'key': ('db.ReferenceProperty', 'db.Key', 'ndb.KeyProperty'),
+}
+# the kind that generated key properties point to; these entities are never created
+KEY_TARGET_KIND = 'ModelgenTarget'
+LIST_LENGTH = 3
+
+
+class PropertySpec(object):
+    """Describes count properties of one type in a schema. size is the length of string, text and
+    key name values, and length is the number of values in repeated properties. Both are either
+    an int, or a (min, max) tuple to pick uniformly distributed random sizes."""
+
+    def __init__(self, property_type, count=1, repeated=False, indexed=False,
+            size=STRING_LENGTH, length=LIST_LENGTH):
+        if property_type not in PROPERTY_TYPES:
+            raise ValueError('unknown property type %r; expected one of %s' % (
+                property_type, ', '.join(sorted(PROPERTY_TYPES))))
+        if property_type == 'text' and indexed:
+            raise ValueError('text properties cannot be indexed')
+        self.property_type = property_type
+        self.count = count
+        self.repeated = repeated
+        self.indexed = indexed
+        self.size = size
+        self.length = length
+
+    def __repr__(self):
+        return 'PropertySpec(%r, count=%d, repeated=%r, indexed=%r, size=%r, length=%r)' % (
+            self.property_type, self.count, self.repeated, self.indexed, self.size, self.length)
+
+
+def parse_schema(text):
+    """Returns a list of PropertySpecs from a comma-separated string of TYPE[*COUNT][:OPTION...],
+    where the options are indexed, repeated, size=N[-M] and length=N[-M]. For example:
+    'string*10:indexed,int*5,text*2:size=1000-5000,string*3:repeated:length=0-10'."""
+
+    specs = []
+    for entry in text.split(','):
+        parts = entry.strip().split(':')
+        property_type, _, count = parts[0].partition('*')
+        kwargs = {}
+        for option in parts[1:]:
+            name, _, value = option.partition('=')
+            if name in ('indexed', 'repeated') and not value:
+                kwargs[name] = True
+            elif name in ('size', 'length') and value:
+                low, _, high = value.partition('-')
+                kwargs[name] = (int(low), int(high)) if high else int(low)
+            else:
+                raise ValueError('invalid option %r in schema entry %r' % (option, entry))
+        specs.append(PropertySpec(property_type, int(count or 1), **kwargs))
+    return specs
+
+
+def property_specs(specs):
+    """Returns a list of (property name, PropertySpec) for the properties described by specs."""
+
+    out = []
+    for spec in specs:
+        for _ in xrange(spec.count):
+            out.append(('%s_%s' % (spec.property_type, base26(len(out))), spec))
     return out
 
 
-def instance(model_class):
-    inst = model_class()
+def property_code(spec, ndb_model):
+    """Returns the source code for the property class described by spec."""
+
+    db_property, list_item_type, ndb_property = PROPERTY_TYPES[spec.property_type]
+    if ndb_model:
+        if spec.repeated:
+            return '%s(indexed=%r, repeated=True)' % (ndb_property, spec.indexed)
+        return '%s(indexed=%r)' % (ndb_property, spec.indexed)
+    if spec.repeated:
+        return 'db.ListProperty(%s, indexed=%r)' % (list_item_type, spec.indexed)
+    if spec.property_type == 'text':
+        # always unindexed
+        return '%s()' % db_property
+    return '%s(indexed=%r)' % (db_property, spec.indexed)
+
+
+def schema_code(class_name, specs, ndb_model=False):
+    """Returns the source code for a model class with the properties described by specs. The code
+    needs SCHEMA_IMPORTS."""
+
+    out = []
+    if ndb_model:
+        out.append('class %s(ndb.Model):' % class_name)
+    else:
+        out.append('class %s(db.Model):' % class_name)
+    for name, spec in property_specs(specs):
+        out.append('    %s = %s' % (name, property_code(spec, ndb_model)))
+    if not specs:
+        out.append('    pass')
+    return '\n'.join(out) + '\n'
+
+
+def model_class(class_name, specs, ndb_model=False):
+    """Returns a new model class with the properties described by specs. instance() uses the
+    specs to create random values of the right sizes."""
+
+    exec_globals = {}
+    exec SCHEMA_IMPORTS + '\n' + schema_code(class_name, specs, ndb_model) in exec_globals
+    cls = exec_globals[class_name]
+    cls._modelgen_specs = specs
+    return cls
 
-    if isinstance(inst, db.Model):
+
+def random_size(size, rng=random):
+    if isinstance(size, tuple):
+        return rng.randint(*size)
+    return size
+
+
+DATETIME_START = datetime.datetime(2000, 1, 1)
+DATETIME_RANGE_SECONDS = 20 * 365 * 24 * 60 * 60
+def random_value(spec, ndb_model, rng=random, letters=random_string):
+    """Returns a random value for a property described by spec, using rng (a random.Random or
+    the random module), and letters(length) for strings."""
+
+    if spec.repeated:
+        return [random_item(spec, ndb_model, rng, letters)
+            for _ in xrange(random_size(spec.length, rng))]
+    return random_item(spec, ndb_model, rng, letters)
+
+
+def random_item(spec, ndb_model, rng=random, letters=random_string):
+    property_type = spec.property_type
+    if property_type == 'string':
+        return letters(random_size(spec.size, rng))
+    elif property_type == 'text':
+        value = letters(random_size(spec.size, rng))
+        if ndb_model:
+            return value
+        return db.Text(value)
+    elif property_type == 'int':
+        return rng.randint(-(1 << 63), (1 << 63) - 1)
+    elif property_type == 'float':
+        return rng.uniform(-1e9, 1e9)
+    elif property_type == 'bool':
+        return rng.random() < 0.5
+    elif property_type == 'datetime':
+        return DATETIME_START + datetime.timedelta(
+            seconds=rng.randrange(DATETIME_RANGE_SECONDS),
+            microseconds=rng.randrange(1000000))
+    else:
+        assert property_type == 'key'
+        name = letters(random_size(spec.size, rng))
+        if ndb_model:
+            return ndb.Key(KEY_TARGET_KIND, name)
+        return db.Key.from_path(KEY_TARGET_KIND, name)
+
+
+# property classes -> types, in order: subclasses must come before their base classes
+DB_PROPERTY_TYPES = (
+    (db.StringProperty, 'string'),
+    (db.TextProperty, 'text'),
+    (db.IntegerProperty, 'int'),
+    (db.FloatProperty, 'float'),
+    (db.BooleanProperty, 'bool'),
+    (db.DateTimeProperty, 'datetime'),
+    (db.ReferenceProperty, 'key'),
+)
+DB_LIST_ITEM_TYPES = {
+    basestring: 'string',
+    db.Text: 'text',
+    int: 'int',
+    long: 'int',
+    float: 'float',
+    bool: 'bool',
+    datetime.datetime: 'datetime',
+    db.Key: 'key',
+}
+NDB_PROPERTY_TYPES = (
+    (ndb.StringProperty, 'string'),
+    (ndb.TextProperty, 'text'),
+    (ndb.IntegerProperty, 'int'),
+    (ndb.FloatProperty, 'float'),
+    (ndb.BooleanProperty, 'bool'),
+    (ndb.DateTimeProperty, 'datetime'),
+    (ndb.KeyProperty, 'key'),
+)
+def infer_spec(property_object):
+    """Returns a PropertySpec for an existing db or ndb property. Unknown types are strings."""
+
+    if isinstance(property_object, db.ListProperty):
+        property_type = DB_LIST_ITEM_TYPES.get(property_object.item_type, 'string')
+        return PropertySpec(property_type, repeated=True, indexed=property_object.indexed)
+    if isinstance(property_object, db.Property):
+        types = DB_PROPERTY_TYPES
+        repeated = False
+        indexed = property_object.indexed
+    else:
+        types = NDB_PROPERTY_TYPES
+        repeated = property_object._repeated
+        indexed = property_object._indexed
+
+    property_type = 'string'
+    for property_class, type_name in types:
+        if isinstance(property_object, property_class):
+            property_type = type_name
+            break
+    return PropertySpec(property_type, repeated=repeated,
+        indexed=indexed and property_type != 'text')
+
+
+def model_property_specs(model_class, specs=None):
+    """Returns a list of (property name, PropertySpec) for model_class. specs defaults to the specs
+    model_class was created with by model_class(); otherwise they are inferred from the property
+    types, with the default sizes."""
+
+    if specs is None:
+        specs = getattr(model_class, '_modelgen_specs', None)
+    if specs is not None:
+        return property_specs(specs)
+
+    if issubclass(model_class, db.Model):
         property_dict = model_class.properties()
     else:
         property_dict = model_class._properties
+    return [(name, infer_spec(property_object))
+        for name, property_object in sorted(property_dict.iteritems())]
+
+
+def instance(model_class, specs=None):
+    """Returns an instance of model_class with random property values. specs is the same as for
+    model_property_specs."""
 
-    for name, property_metadata in property_dict.iteritems():
-        # assuming everything is a string
-        setattr(inst, name, random_string())
+    inst = model_class()
+    ndb_model = not isinstance(inst, db.Model)
+    for name, spec in model_property_specs(model_class, specs):
+        setattr(inst, name, random_value(spec, ndb_model))
     return inst
 
 
+LETTER_BUFFER_SIZE = 1 << 16
+class BulkGenerator(object):
+    """Generates random data for model_class much faster than instance(), for large synthetic
+    datasets: as property dicts, or as EntityProtos ready to put with datastore_lazy, without
+    creating models or running their validation. Letters for strings are generated
+    LETTER_BUFFER_SIZE at a time. Everything is generated from a random.Random(seed), so the same
+    seed always produces the same data. Entities get ids first_id, first_id + 1, ... so the same
+    seed also produces the same keys. specs is the same as for model_property_specs."""
+
+    def __init__(self, model_class, seed=0, specs=None, first_id=1):
+        self.model_class = model_class
+        self.ndb_model = not issubclass(model_class, db.Model)
+        if self.ndb_model:
+            self.kind = model_class._get_kind()
+        else:
+            self.kind = model_class.kind()
+        self.__named_specs = model_property_specs(model_class, specs)
+        self.__rng = random.Random(seed)
+        self.__next_id = first_id
+        self.__letters = ''
+        self.__letters_pos = 0
+
+    def letters(self, length):
+        """Returns the next length random letters."""
+
+        pos = self.__letters_pos
+        if pos + length > len(self.__letters):
+            self.__letters = random_letters(self.__rng, max(length, LETTER_BUFFER_SIZE))
+            pos = 0
+        self.__letters_pos = pos + length
+        return self.__letters[pos:pos + length]
+
+    def property_dicts(self, count):
+        """Yields count dicts of property name -> value, with values of the types the model
+        class uses (e.g. ndb.Key for ndb models), which can be passed to the model constructor."""
+
+        rng = self.__rng
+        for _ in xrange(count):
+            yield dict((name, random_value(spec, self.ndb_model, rng, self.letters))
+                for name, spec in self.__named_specs)
+
+    def entity_protos(self, count):
+        """Yields count EntityProtos with complete keys, stored the way db stores the properties
+        (ndb reads them the same way)."""
+
+        app = datastore_types.ResolveAppId(None)
+        rng = self.__rng
+        for _ in xrange(count):
+            entity_proto = entity_pb.EntityProto()
+            key_proto = entity_proto.mutable_key()
+            key_proto.set_app(app)
+            element = key_proto.mutable_path().add_element()
+            element.set_type(self.kind)
+            element.set_id(self.__next_id)
+            self.__next_id += 1
+            entity_proto.mutable_entity_group().add_element().CopyFrom(element)
+
+            for name, spec in self.__named_specs:
+                property_type = spec.property_type
+                if property_type in ('string', 'text') and not spec.repeated:
+                    # the common case: skip ToPropertyPb
+                    prop = entity_pb.Property()
+                    prop.set_name(name)
+                    prop.set_multiple(False)
+                    prop.mutable_value().set_stringvalue(
+                        self.letters(random_size(spec.size, rng)))
+                    if property_type == 'text':
+                        prop.set_meaning(entity_pb.Property.TEXT)
+                    props = [prop]
+                else:
+                    # db values: ToPropertyPb does not accept ndb.Keys
+                    props = datastore_types.ToPropertyPb(name,
+                        random_value(spec, False, rng, self.letters))
+                    if not isinstance(props, list):
+                        props = [props]
+                if spec.indexed and property_type != 'text':
+                    entity_proto.property_list().extend(props)
+                else:
+                    entity_proto.raw_property_list().extend(props)
+            yield entity_proto
+
+
 if __name__ == "__main__":
     print DB_IMPORT
     print
@@ -1,6 +1,8 @@
 from google.appengine.ext import db
 from google.appengine.ext import ndb
 
+import datastore_lazy
+
 class Model10(db.Model):
     prop_a = db.StringProperty(indexed=False)
     prop_b = db.StringProperty(indexed=False)
@@ -424,3 +426,15 @@ class NdbExpando100(ndb.Expando):
     prop_td = ndb.StringProperty(indexed=False)
     prop_ud = ndb.StringProperty(indexed=False)
     prop_vd = ndb.StringProperty(indexed=False)
+
+
+class LazyModel100(datastore_lazy.LazyModel, Model100):
+    pass
+
+
+class LazyNdbModel100(datastore_lazy.LazyNdbModel, NdbModel100):
+    pass
+
+
+class LazyNdbExpando100(datastore_lazy.LazyNdbModel, NdbExpando100):
+    pass
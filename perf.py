@@ -1,3 +1,5 @@
+import StringIO
+import sys
 import time
 import logging
 
@@ -7,8 +9,11 @@ from google.appengine.ext import db
 from google.appengine.ext import ndb
 import webapp2
 
+import benchstats
+import bulkload
 import datastore_lazy
-import modelgen
+import dscost
+import entity_cache
 import models_generated
 
 # Produces lots of output but lets you view what the entities actually look like
@@ -23,58 +28,117 @@ def ndb_get_multi_nocache(keys):
     # which is what we want to measure
     return ndb.get_multi(keys, use_cache=False, use_memcache=False)
 
-ITERATIONS = 10
-def bench(response, model_class, keys):
+def property_count(model_class):
     if issubclass(model_class, db.Model):
-        get_func = db.get
-    else:
-        get_func = ndb_get_multi_nocache
+        return len(model_class.properties())
+    return len(model_class._properties)
 
-    for i in xrange(ITERATIONS):
-        total = 0
-        start = time.time()
-        entities = get_func(keys)
-        end = time.time()
-        output(response, '  %s.get %d entities in %f seconds (total: %d)' % (
-            model_class.__name__, len(entities), (end-start), total))
-
-    if issubclass(model_class, ndb.Model):
-        keys = [k.to_old_key() for k in keys]
+def first_property_names(model_class, count):
+    """Returns the names of the first count properties of model_class, in the order modelgen
+    generates them (prop_a, prop_b, ...)."""
 
-    for i in xrange(ITERATIONS):
-        start = time.time()
-        rpc = datastore.GetAsync(keys)
-        entities = rpc.get_result()
-        end = time.time()
-
-        if DUMP_ENTITIES and i == 0:
-            response.write('\n')
-            response.write('## ENTITY CONTENTS:\n')
-            response.write(repr(entities))
-            response.write('\n\n')
-
-            for i, entity in enumerate(entities):
-                response.write('  %d: %d keys %d serialized bytes\n' % (i, len(entity), entity.ToPb().ByteSize()))
+    if issubclass(model_class, db.Model):
+        names = model_class.properties().keys()
+    else:
+        names = model_class._properties.keys()
+    return sorted(names, key=lambda name: (len(name), name))[:count]
 
-        output(response, '  datastore.GetAsync %d entities in %f seconds (total %d)' % (
-            len(entities), (end-start), total))
+def add_record(records, name, model_class, entity_count, timings):
+    """Appends a benchstats record for timings to records, if it is not None."""
 
-    for i in xrange(ITERATIONS):
-        start = time.time()
-        entities = datastore_lazy.get(keys)
-        end = time.time()
+    if records is not None:
+        records.append(benchstats.make_record(name, model_class.__name__,
+            property_count(model_class), entity_count, timings))
 
-        output(response, '  datastore_lazy.get %d entities in %f seconds (total %d)' % (
-            len(entities), (end-start), total))
+ITERATIONS = 10
+def bench(response, model_class, keys, records=None):
+    if DUMP_ENTITIES:
+        entities = datastore.GetAsync(datastore_lazy._to_db_keys(keys)).get_result()
+        response.write('\n')
+        response.write('## ENTITY CONTENTS:\n')
+        response.write(repr(entities))
+        response.write('\n\n')
+
+        for i, entity in enumerate(entities):
+            response.write('  %d: %d keys %d serialized bytes\n' % (i, len(entity), entity.ToPb().ByteSize()))
+
+    for name, get_func in get_scenarios(model_class, keys):
+        timings = []
+        for i in xrange(ITERATIONS):
+            start = time.time()
+            num_entities = get_func()
+            end = time.time()
+            timings.append(end - start)
+            output(response, '  %s %d entities in %f seconds' % (name, num_entities, (end-start)))
+        add_record(records, name, model_class, len(keys), timings)
+
+
+def get_scenarios(model_class, keys):
+    """Returns a list of (name, function) for the ways to get the entities for keys. Each function
+    gets all the entities once, and returns the number of entities."""
+
+    if issubclass(model_class, datastore_lazy.LazyModel):
+        get_func = model_class.get
+    elif issubclass(model_class, db.Model):
+        get_func = db.get
+    else:
+        get_func = ndb_get_multi_nocache
+    # the remaining functions need db.Keys
+    model_keys = keys
+    keys = datastore_lazy._to_db_keys(keys)
+
+    def model_get():
+        return len(get_func(model_keys))
+
+    def datastore_get_async():
+        return len(datastore.GetAsync(keys).get_result())
+
+    def lazy_get():
+        return len(datastore_lazy.get(keys))
+
+    def lazy_get_async_batches():
+        # fan out: the same keys as 4 parallel RPCs
+        rpc = datastore_lazy.get_async(keys, batch_size=max(1, len(keys) / 4))
+        return len(rpc.get_result())
+
+    cache = entity_cache.EntityCache()
+    entity_cache.get(keys, cache=cache)
+    def entity_cache_get():
+        return len(entity_cache.get(keys, cache=cache))
+
+    column_names = first_property_names(model_class, 5)
+    def lazy_get_read_properties():
+        return read_columns(datastore_lazy.get(keys), column_names)
+
+    def lazy_get_projection_read_properties():
+        return read_columns(datastore_lazy.get(keys, projection=column_names), column_names)
+
+    def lazy_get_columns():
+        return len(datastore_lazy.get_columns(keys, column_names)['__key__'])
+
+    return [
+        ('%s.get' % model_class.__name__, model_get),
+        ('datastore.GetAsync', datastore_get_async),
+        ('datastore_lazy.get', lazy_get),
+        ('datastore_lazy.get_async (4 batches)', lazy_get_async_batches),
+        ('entity_cache.get (all hits)', entity_cache_get),
+        ('datastore_lazy.get + read 5 properties', lazy_get_read_properties),
+        ('datastore_lazy.get projection + read 5 properties',
+            lazy_get_projection_read_properties),
+        ('datastore_lazy.get_columns 5 properties', lazy_get_columns),
+    ]
 
 DB_MODEL_CLASSES = [
     models_generated.Model10,
     models_generated.Model100,
     models_generated.Expando100,
+    models_generated.LazyModel100,
 ]
 NDB_MODEL_CLASSES = [
     models_generated.NdbModel100,
     models_generated.NdbExpando100,
+    models_generated.LazyNdbModel100,
+    models_generated.LazyNdbExpando100,
 ]
 MODEL_CLASSES = DB_MODEL_CLASSES + NDB_MODEL_CLASSES
 
@@ -83,19 +147,15 @@ class DbEntitySetup(webapp2.RequestHandler):
     def get(self):
         self.response.headers['Content-Type'] = 'text/plain;charset=UTF-8'
 
-        instances = []
-        ndb_instances = []
-        for _ in xrange(INSTANCES_TO_CREATE):
-            for model_class in MODEL_CLASSES:
-                instance = modelgen.instance(model_class)
-                if isinstance(instance, db.Model):
-                    instances.append(instance)
-                else:
-                    ndb_instances.append(instance)
-        db.put(instances)
-        ndb.put_multi(ndb_instances)
-        self.response.write('Put %d entities to the datastore' % (
-            len(instances) + len(ndb_instances)))
+        # e.g. /db_entity_setup?count=10000&chunk_size=200&in_flight=8 to load more. The same
+        # seed always writes the same entities with the same keys, replacing any from before
+        count = int(self.request.get('count', INSTANCES_TO_CREATE))
+        chunk_size = int(self.request.get('chunk_size', bulkload.DEFAULT_CHUNK_SIZE))
+        in_flight = int(self.request.get('in_flight', bulkload.DEFAULT_MAX_IN_FLIGHT))
+        seed = int(self.request.get('seed', 0))
+        instances = bulkload.generate_protos(MODEL_CLASSES, count, seed)
+        stats = bulkload.load(instances, chunk_size, in_flight)
+        self.response.write('Put ' + stats.summary())
 
 
 NUM_INSTANCES_TO_DESERIALIZE = 20
@@ -110,7 +170,7 @@ def find_keys(model_class, limit):
     return keys
 
 
-def find_keys_and_bench(response, model_class):
+def find_keys_and_bench(response, model_class, records=None):
     # Query for models
     keys = find_keys(model_class, NUM_INSTANCES_TO_DESERIALIZE)
 
@@ -125,8 +185,42 @@ def find_keys_and_bench(response, model_class):
         response.write("\n\n### ERROR NO ENTITIES ###")
         return
 
-    bench(response, model_class, keys)
+    bench(response, model_class, keys, records)
+    bench_query(response, model_class, records)
+
+
+def bench_query(response, model_class, records=None):
+    for name, query_func in query_scenarios(model_class):
+        timings = []
+        for i in xrange(ITERATIONS):
+            start = time.time()
+            num_entities = query_func()
+            end = time.time()
+            timings.append(end - start)
+            output(response, '  %s %d entities in %f seconds' % (name, num_entities, (end-start)))
+        add_record(records, name, model_class, num_entities, timings)
+
+
+def query_scenarios(model_class, limit=NUM_INSTANCES_TO_DESERIALIZE):
+    """Returns a list of (name, function) for the ways to query for limit entities of model_class,
+    like get_scenarios."""
+
+    if issubclass(model_class, db.Model):
+        kind = model_class.kind()
+    else:
+        kind = model_class._get_kind()
+
+    def keys_only_query_lazy_get():
+        keys = find_keys(model_class, limit)
+        return len(datastore_lazy.get(keys))
+
+    def lazy_query():
+        return len(list(datastore_lazy.query(kind, batch_size=limit, limit=limit)))
 
+    return [
+        ('keys-only query + datastore_lazy.get', keys_only_query_lazy_get),
+        ('datastore_lazy.query', lazy_query),
+    ]
 
 
 class PythonListHolder(object):
@@ -137,137 +231,261 @@ class PythonListHolder(object):
         return len(self._list)
 
 
+def lazy_entity_overhead(entity):
+    """Returns the approximate bytes used by a LazyEntity or CompactLazyEntity, not counting the
+    protocol buffer messages and property values, which are the same for both."""
+    size = sys.getsizeof(entity)
+    if isinstance(entity, datastore_lazy.CompactLazyEntity):
+        size += sys.getsizeof(entity._props)
+        if entity._values is not None:
+            size += sys.getsizeof(entity._values)
+    else:
+        size += sys.getsizeof(entity.__dict__)
+        size += sys.getsizeof(entity._LazyEntity__properties)
+        size += sys.getsizeof(entity._LazyEntity__dirty)
+    return size
+
+
 SERIALIZATION_ITERATIONS = 100
 def benchmark_serialization(response, model_instance):
+    section = None
+    for scenario_section, name, func in serialization_scenarios(model_instance):
+        if scenario_section != section:
+            section = scenario_section
+            response.write('\n### %s\n' % section)
+        start = time.time()
+        for _ in xrange(SERIALIZATION_ITERATIONS):
+            func()
+        end = time.time()
+        output(response, '%s %d times in %f s' % (name, SERIALIZATION_ITERATIONS, end-start))
+
+    entity = model_instance._populate_entity(datastore.Entity)
+    output(response, '  (entity has %d keys)' % len(entity))
+
+    serialized = entity.ToPb().SerializeToString()
+    decoders = datastore_lazy.compile_decoders(type(model_instance))
+    response.write('\n### LazyEntity memory per entity after accessing five properties\n')
+    for entity_class in (datastore_lazy.LazyEntity, datastore_lazy.CompactLazyEntity):
+        deserialized = entity_class(entity_pb.EntityProto(serialized), decoders)
+        for name in ('prop_a', 'prop_b', 'prop_c', 'prop_d', 'prop_e'):
+            getattr(deserialized, name)
+        output(response, '%s uses %d bytes (excluding protocol buffers and values)' % (
+            entity_class.__name__, lazy_entity_overhead(deserialized)))
+
+    # output(response, '\n')
+    # output(response, 'path: ' + repr(model_instance.key().to_path()))
+    # output(response, str(entity_proto))
+    # output(response, '\n')
+
+
+def serialization_scenarios(model_instance):
+    """Returns a list of (section, name, function) for the steps of serializing and deserializing
+    model_instance, and accessing its properties. Each function runs its step once."""
+
     # How data gets from a db.Model subclass to bytes:
     # 1. db.Model is converted to a datastore.Entity
     # 2. datastore.Entity is converted to a protocol buffer object: EntityProto
     # 3. EntityProto is serialized
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
+    entity = model_instance._populate_entity(datastore.Entity)
+    entity_proto = entity.ToPb()
+    serialized = entity_proto.SerializeToString()
+    reused_proto = entity_pb.EntityProto()
+    decoders = datastore_lazy.compile_decoders(type(model_instance))
+    obj = PythonListHolder()
+
+    def serialize_from_model():
         entity = model_instance._populate_entity(datastore.Entity)
-        entity_proto = entity.ToPb()
-        serialized = entity_proto.SerializeToString()
-    end = time.time()
-    output(response, 'serialized from model %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto = entity.ToPb()
-        serialized = entity_proto.SerializeToString()
-    end = time.time()
-    output(response, 'serialized from datastore.Entity %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        serialized = entity_proto.SerializeToString()
-    end = time.time()
-    output(response, 'serialized from entity_pb.EntityProto %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto = entity_pb.EntityProto(serialized)
-        entity = datastore.Entity.FromPb(entity_proto)
-        # from model_from_protobuf
-        deserialized = db.class_for_kind(entity.kind()).from_entity(entity)
-    end = time.time()
-    output(response, 'deserialized to model %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto = entity_pb.EntityProto(serialized)
-        entity = datastore.Entity.FromPb(entity_proto)
-    end = time.time()
-    output(response, 'deserialized to datastore.Entity %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto = entity_pb.EntityProto(serialized)
-    end = time.time()
-    output(response, 'deserialized to entity_pb.EntityProto %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto.Clear()
-        entity_proto.MergeFromString(serialized)
-    end = time.time()
-    output(response, 'deserialized to entity_pb.EntityProto with reuse %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-    output(response, '  (entity has %d keys)' % len(entity))
+        return entity.ToPb().SerializeToString()
 
-    # model / LazyEntity property access tests
-    response.write('\n### model / LazyEntity property access times\n')
-    total_length = 0
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto = entity_pb.EntityProto(serialized)
-        entity = datastore.Entity.FromPb(entity_proto)
-        # from model_from_protobuf
-        deserialized = db.class_for_kind(entity.kind()).from_entity(entity)
-        total_length += len(deserialized.prop_a)
-    end = time.time()
-    output(response, 'model deserialized and accessed one property %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    total_length = 0
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto = entity_pb.EntityProto(serialized)
-        entity = datastore.Entity.FromPb(entity_proto)
+    def serialize_from_model_encoders():
+        return datastore_lazy.model_to_pb(model_instance).SerializeToString()
+
+    def serialize_from_entity():
+        return entity.ToPb().SerializeToString()
+
+    def serialize_from_proto():
+        return entity_proto.SerializeToString()
+
+    def deserialize_to_model():
+        entity = datastore.Entity.FromPb(entity_pb.EntityProto(serialized))
         # from model_from_protobuf
-        deserialized = db.class_for_kind(entity.kind()).from_entity(entity)
-        total_length += len(deserialized.prop_a)
-        total_length += len(deserialized.prop_b)
-        total_length += len(deserialized.prop_c)
-        total_length += len(deserialized.prop_d)
-        total_length += len(deserialized.prop_e)
-    end = time.time()
-    output(response, 'model deserialized and accessed five properties %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    total_length = 0
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto = entity_pb.EntityProto(serialized)
-        deserialized = datastore_lazy.LazyEntity(entity_proto)
-        total_length += len(deserialized.prop_a)
-    end = time.time()
-    output(response, 'LazyEntity deserialized and accessed one property %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    total_length = 0
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        entity_proto = entity_pb.EntityProto(serialized)
-        deserialized = datastore_lazy.LazyEntity(entity_proto)
-        total_length += len(deserialized.prop_a)
-        total_length += len(deserialized.prop_b)
-        total_length += len(deserialized.prop_c)
-        total_length += len(deserialized.prop_d)
-        total_length += len(deserialized.prop_e)
-    end = time.time()
-    output(response, 'LazyEntity deserialized and accessed five properties %d times in %f s' % (SERIALIZATION_ITERATIONS, end-start))
-
-    response.write('\n### protocol buffer / pure python access times\n')
-    total = 0
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        total += entity_proto.property_size()
-    end = time.time()
-    output(response, 'protocol buffer entity_proto.property_size access in %f s' % (end-start))
-
-    total = 0
-    obj = PythonListHolder()
-    start = time.time()
-    for _ in xrange(SERIALIZATION_ITERATIONS):
-        total += obj.property_size()
-    end = time.time()
-    output(response, 'PythonListHolder.property_size access in %f s' % (end-start))
+        return db.class_for_kind(entity.kind()).from_entity(entity)
+
+    def deserialize_to_entity():
+        return datastore.Entity.FromPb(entity_pb.EntityProto(serialized))
+
+    def deserialize_to_proto():
+        return entity_pb.EntityProto(serialized)
+
+    def deserialize_to_proto_reuse():
+        reused_proto.Clear()
+        reused_proto.MergeFromString(serialized)
+
+    def model_one_property():
+        return len(deserialize_to_model().prop_a)
+
+    def model_five_properties():
+        return read_five_properties(deserialize_to_model())
+
+    def lazy_one_property():
+        return len(datastore_lazy.LazyEntity(entity_pb.EntityProto(serialized)).prop_a)
+
+    def lazy_five_properties():
+        return read_five_properties(datastore_lazy.LazyEntity(entity_pb.EntityProto(serialized)))
+
+    def lazy_decoders_five_properties():
+        return read_five_properties(
+            datastore_lazy.LazyEntity(entity_pb.EntityProto(serialized), decoders))
+
+    def raw_lazy_five_properties():
+        return read_five_properties(datastore_lazy.RawLazyEntity(serialized, decoders=decoders))
+
+    def compact_lazy_five_properties():
+        return read_five_properties(
+            datastore_lazy.CompactLazyEntity(entity_pb.EntityProto(serialized), decoders))
+
+    def model_modify():
+        deserialized = deserialize_to_model()
+        deserialized.prop_a = 'modified'
+        entity = deserialized._populate_entity(datastore.Entity)
+        return entity.ToPb().SerializeToString()
+
+    def lazy_modify():
+        deserialized = datastore_lazy.LazyEntity(entity_pb.EntityProto(serialized))
+        deserialized.prop_a = 'modified'
+        return datastore_lazy.serialize(deserialized)
+
+    def proto_property_size():
+        return entity_proto.property_size()
+
+    def python_property_size():
+        return obj.property_size()
+
+    serialization = 'serialization / deserialization times'
+    access = 'model / LazyEntity property access times'
+    modify = 'model / LazyEntity modify one property and serialize times'
+    python = 'protocol buffer / pure python access times'
+    return [
+        (serialization, 'serialized from model', serialize_from_model),
+        (serialization, 'serialized from model with datastore_lazy.model_to_pb',
+            serialize_from_model_encoders),
+        (serialization, 'serialized from datastore.Entity', serialize_from_entity),
+        (serialization, 'serialized from entity_pb.EntityProto', serialize_from_proto),
+        (serialization, 'deserialized to model', deserialize_to_model),
+        (serialization, 'deserialized to datastore.Entity', deserialize_to_entity),
+        (serialization, 'deserialized to entity_pb.EntityProto', deserialize_to_proto),
+        (serialization, 'deserialized to entity_pb.EntityProto with reuse',
+            deserialize_to_proto_reuse),
+        (access, 'model deserialized and accessed one property', model_one_property),
+        (access, 'model deserialized and accessed five properties', model_five_properties),
+        (access, 'LazyEntity deserialized and accessed one property', lazy_one_property),
+        (access, 'LazyEntity deserialized and accessed five properties', lazy_five_properties),
+        (access, 'LazyEntity with compiled decoders deserialized and accessed five properties',
+            lazy_decoders_five_properties),
+        (access, 'RawLazyEntity deserialized and accessed five properties',
+            raw_lazy_five_properties),
+        (access, 'CompactLazyEntity deserialized and accessed five properties',
+            compact_lazy_five_properties),
+        (modify, 'model modified one property and serialized', model_modify),
+        (modify, 'LazyEntity modified one property and serialized', lazy_modify),
+        (python, 'protocol buffer entity_proto.property_size access', proto_property_size),
+        (python, 'PythonListHolder.property_size access', python_property_size),
+    ]
+
+
+def read_columns(entities, names):
+    """Reads each of names from every entity into a list per name, like building a report, and
+    returns the number of values read."""
+
+    columns = [[getattr(entity, name) for entity in entities] for name in names]
+    return sum(len(column) for column in columns)
+
+
+def read_five_properties(entity):
+    return (len(entity.prop_a) + len(entity.prop_b) + len(entity.prop_c) + len(entity.prop_d) +
+        len(entity.prop_e))
+
+
+def concurrency_scenarios(model_class, keys):
+    """Returns a list of (name, function, check) for getting keys from many threads at once. Each
+    check returns an error message if the result does not have the right type or keys, which
+    would happen if datastore_lazy's connections leaked into the normal datastore calls."""
+
+    db_keys = datastore_lazy._to_db_keys(keys)
+    if issubclass(model_class, db.Model):
+        model_get = ('db.get', lambda: db.get(keys))
+        def model_key(instance):
+            return instance.key()
+    else:
+        model_get = ('ndb.get_multi', lambda: ndb_get_multi_nocache(keys))
+        def model_key(instance):
+            return instance.key.to_old_key()
+
+    def check_models(results):
+        return check_results(results, model_class, model_key)
+
+    def check_lazy(results):
+        return check_results(results, datastore_lazy.LazyEntity, lambda entity: entity.key())
+
+    def check_results(results, expected_class, get_key):
+        for result in results:
+            if not isinstance(result, expected_class):
+                return 'expected %s, got %s' % (expected_class.__name__, type(result).__name__)
+        if [get_key(result) for result in results] != db_keys:
+            return 'wrong keys'
+        return None
+
+    return [
+        (model_get[0], model_get[1], check_models),
+        ('datastore_lazy.get', lambda: datastore_lazy.get(db_keys), check_lazy),
+    ]
+
+
+THREAD_COUNTS = (1, 2, 4, 8, 16)
+CONCURRENCY_CALLS_PER_THREAD = 10
+def bench_concurrency(response, model_class, keys, thread_counts=THREAD_COUNTS,
+        calls_per_thread=CONCURRENCY_CALLS_PER_THREAD):
+    """Runs the concurrency scenarios with each number of threads, and returns the total number of
+    errors."""
+
+    total_errors = 0
+    for name, func, check in concurrency_scenarios(model_class, keys):
+        for num_threads in thread_counts:
+            latencies, elapsed, errors = benchstats.run_concurrently(func, check, num_threads,
+                calls_per_thread)
+            output(response, '  ' + benchstats.format_concurrency(name, num_threads, latencies,
+                elapsed, errors))
+            for error in sorted(set(errors)):
+                output(response, '    ERROR: ' + error)
+            total_errors += len(errors)
+    return total_errors
+
+
+class ConcurrencyTest(webapp2.RequestHandler):
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain;charset=UTF-8'
+        # e.g. /concurrency_test?threads=1,4,16
+        thread_counts = THREAD_COUNTS
+        if self.request.get('threads'):
+            thread_counts = [int(n) for n in self.request.get('threads').split(',')]
 
-    # output(response, '\n')
-    # output(response, 'path: ' + repr(model_instance.key().to_path()))
-    # output(response, str(entity_proto))
-    # output(response, '\n')
+        for model_class in MODEL_CLASSES:
+            self.response.write('\n\n## %s:\n' % (model_class.__name__))
+            keys = find_keys(model_class, NUM_INSTANCES_TO_DESERIALIZE)
+            bench_concurrency(self.response, model_class, keys, thread_counts)
 
 
 class DbEntityTest(webapp2.RequestHandler):
     def get(self):
+        # ?format=json returns benchstats records instead of the text report
+        if self.request.get('format') == 'json':
+            records = []
+            for model_class in MODEL_CLASSES:
+                find_keys_and_bench(StringIO.StringIO(), model_class, records)
+            self.response.headers['Content-Type'] = 'application/json'
+            benchstats.write_json(records, self.response)
+            return
+
         self.response.headers['Content-Type'] = 'text/plain;charset=UTF-8'
 
         for model_class in MODEL_CLASSES:
@@ -286,8 +504,11 @@ class SerializationTest(webapp2.RequestHandler):
             benchmark_serialization(self.response, instance)
 
 
-app = webapp2.WSGIApplication([
+# with ?dscost=1, logs the datastore RPCs, entities and conversion time of the request. Not by
+# default: recording patches the SDK's conversion functions, which would skew the benchmarks
+app = dscost.CostMiddleware(webapp2.WSGIApplication([
     ('/db_entity_setup', DbEntitySetup),
     ('/db_entity_test', DbEntityTest),
     ('/serialization_test', SerializationTest),
-])
+    ('/concurrency_test', ConcurrencyTest),
+]), query_param='dscost')
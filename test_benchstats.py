@@ -0,0 +1,83 @@
+import itertools
+import json
+import StringIO
+import unittest
+
+import benchstats
+
+
+class Test(unittest.TestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(1, benchstats.percentile(values, 0))
+        self.assertEquals(50, benchstats.percentile(values, 50))
+        self.assertEquals(95, benchstats.percentile(values, 95))
+        self.assertEquals(100, benchstats.percentile(values, 100))
+        self.assertEquals(7, benchstats.percentile([7], 99))
+
+    def test_summarize(self):
+        summary = benchstats.summarize([0.003, 0.001, 0.002])
+        self.assertEquals(3, summary['count'])
+        self.assertEquals(0.001, summary['min'])
+        self.assertEquals(0.002, summary['median'])
+        self.assertEquals(0.003, summary['p99'])
+        self.assertAlmostEquals(0.002, summary['mean'])
+        self.assertIn('median    2.000', benchstats.format_summary('name', summary))
+
+    def test_mann_whitney(self):
+        baseline = [0.010 + i * 0.0001 for i in xrange(30)]
+        slower = [0.012 + i * 0.0001 for i in xrange(30)]
+        self.assertLess(benchstats.mann_whitney_greater(slower, baseline), 0.001)
+        self.assertGreater(benchstats.mann_whitney_greater(baseline, slower), 0.99)
+        self.assertGreater(benchstats.mann_whitney_greater(baseline, baseline), 0.4)
+        self.assertEquals(1.0, benchstats.mann_whitney_greater([], baseline))
+        # all ties
+        self.assertEquals(1.0, benchstats.mann_whitney_greater([1], [1]))
+
+    def test_compare(self):
+        baseline_timings = [0.010 + i * 0.0001 for i in xrange(30)]
+        baseline = [
+            benchstats.make_record('get', 'Model100', 100, 20, baseline_timings, 'test'),
+            benchstats.make_record('put', 'Model100', 100, 20, baseline_timings, 'test'),
+        ]
+        records = [
+            benchstats.make_record('get', 'Model100', 100, 20,
+                [t * 1.5 for t in baseline_timings], 'test'),
+            benchstats.make_record('put', 'Model100', 100, 20, baseline_timings, 'test'),
+            benchstats.make_record('new', 'Model100', 100, 20, baseline_timings, 'test'),
+        ]
+
+        f = StringIO.StringIO()
+        benchstats.write_json(records, f)
+        self.assertEquals(records, json.loads(f.getvalue())['records'])
+
+        comparisons = benchstats.compare(baseline, records)
+        self.assertEquals(2, len(comparisons))
+        self.assertTrue(comparisons[0]['regression'])
+        self.assertAlmostEquals(1.5, comparisons[0]['ratio'])
+        self.assertFalse(comparisons[1]['regression'])
+        self.assertIn('REGRESSION', benchstats.format_comparison(comparisons[0]))
+
+    def test_run_concurrently(self):
+        # count().next is atomic, so each call gets a different number
+        func = itertools.count(1).next
+        def check(result):
+            if result % 2:
+                return None
+            return 'even'
+
+        latencies, elapsed, errors = benchstats.run_concurrently(func, check, 4, 5)
+        self.assertEquals(20, len(latencies))
+        self.assertEquals(['even'] * 10, errors)
+        self.assertGreaterEqual(elapsed, 0)
+        self.assertIn('4 threads', benchstats.format_concurrency('f', 4, latencies, elapsed + 1,
+            errors))
+
+        def fail():
+            raise ValueError('oops')
+        _, _, errors = benchstats.run_concurrently(fail, check, 2, 1)
+        self.assertEquals(['ValueError: oops'] * 2, errors)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import bulkload
+import modelgen
+
+
+class SomeModel(db.Model):
+    foo = db.StringProperty(indexed=False)
+
+
+class SomeNdbModel(ndb.Model):
+    foo = ndb.StringProperty(indexed=False)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # queries must see writes immediately
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_load(self):
+        stats = bulkload.load(bulkload.generate([SomeModel, SomeNdbModel], 10), chunk_size=3,
+            max_in_flight=2, report_seconds=None)
+        self.assertEquals(20, stats.entities)
+        # 4 chunks of each kind: 3 + 3 + 3 + 1
+        self.assertEquals(8, stats.chunks)
+        self.assertEquals(0, stats.retries)
+        self.assertEquals(10, SomeModel.all().count())
+        self.assertEquals(10, SomeNdbModel.query().count())
+        self.assertIn('20 entities', stats.summary())
+
+    def test_load_protos(self):
+        instances = bulkload.generate_protos([SomeModel, SomeNdbModel], 5, seed=3)
+        stats = bulkload.load(instances, chunk_size=2, report_seconds=None)
+        self.assertEquals(10, stats.entities)
+        self.assertEquals(6, stats.chunks)
+        self.assertEquals(5, SomeModel.all().count())
+        instance = SomeNdbModel.get_by_id(1)
+        self.assertEquals(modelgen.STRING_LENGTH, len(instance.foo))
+
+        # the same seed writes the same entities again
+        foo = SomeModel.get_by_id(1).foo
+        bulkload.load(bulkload.generate_protos([SomeModel, SomeNdbModel], 5, seed=3),
+            report_seconds=None)
+        self.assertEquals(5, SomeModel.all().count())
+        self.assertEquals(foo, SomeModel.get_by_id(1).foo)
+        # a different seed writes different entities
+        bulkload.load(bulkload.generate_protos([SomeModel], 1, seed=4), report_seconds=None)
+        self.assertNotEquals(foo, SomeModel.get_by_id(1).foo)
+
+    def test_retry(self):
+        original_put_async = db.put_async
+        failures = [datastore_errors.Timeout('first'), datastore_errors.Timeout('second')]
+        class FailingRpc(object):
+            def __init__(self, error, rpc):
+                self.error = error
+                self.rpc = rpc
+            def get_result(self):
+                # the put was written, but timed out
+                self.rpc.get_result()
+                raise self.error
+        def put_async(models):
+            rpc = original_put_async(models)
+            if failures:
+                return FailingRpc(failures.pop(0), rpc)
+            return rpc
+
+        db.put_async = put_async
+        try:
+            stats = bulkload.load([SomeModel(foo='foo')], retry_delay=0, report_seconds=None)
+            self.assertEquals(2, stats.retries)
+            # the model was given an allocated id, so the retries did not create duplicates
+            self.assertEquals(1, SomeModel.all().count())
+
+            failures.extend([datastore_errors.Timeout()] * 2)
+            with self.assertRaises(datastore_errors.Timeout):
+                bulkload.load([SomeModel(foo='foo')], max_retries=1, retry_delay=0,
+                    report_seconds=None)
+        finally:
+            db.put_async = original_put_async
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,408 @@
+import array
+import datetime
+import unittest
+
+from google.appengine.api import datastore
+from google.appengine.api import namespace_manager
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import benchstats
+import datastore_lazy
+
+
+class SomeModel(db.Model):
+    foo = db.StringProperty(indexed=False)
+    bar = db.StringProperty()
+    baz = db.IntegerProperty(indexed=False)
+
+
+class LazyThing(datastore_lazy.LazyModel, db.Model):
+    foo = db.StringProperty(indexed=False)
+    count = db.IntegerProperty(default=5)
+    names = db.StringListProperty()
+
+
+class LazyNdbThing(datastore_lazy.LazyNdbModel, ndb.Model):
+    foo = ndb.StringProperty(indexed=False)
+    tags = ndb.StringProperty(repeated=True)
+    number = ndb.IntegerProperty()
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # queries in tests must see writes immediately
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_get(self):
+        key = SomeModel(foo='foo', bar='bar', baz=42).put()
+
+        entities = datastore_lazy.get([key])
+        self.assertEquals(1, len(entities))
+        self.assertEquals(key, entities[0].key())
+        self.assertEquals('foo', entities[0].foo)
+        self.assertEquals(42, entities[0].baz)
+        with self.assertRaises(AttributeError):
+            entities[0].missing
+
+    def test_compile_decoders(self):
+        decoders = datastore_lazy.compile_decoders(SomeModel)
+        self.assertEquals(set(['foo', 'bar', 'baz']), set(decoders))
+        self.assertIs(decoders, datastore_lazy.compile_decoders(SomeModel))
+
+        key = SomeModel(foo=u'f\xf6o', bar='bar', baz=42).put()
+        generic = datastore_lazy.get([key])[0]
+        compiled = datastore_lazy.get([key], SomeModel)[0]
+        for name in ('foo', 'bar', 'baz'):
+            self.assertEquals(getattr(generic, name), getattr(compiled, name))
+            self.assertEquals(type(getattr(generic, name)), type(getattr(compiled, name)))
+
+        # list properties decode each value, including StringListProperty
+        self.assertIn('names', datastore_lazy.compile_decoders(LazyThing))
+        list_key = LazyThing(foo='foo', names=[u'a', u'b\xe4']).put()
+        generic = datastore_lazy.get([list_key])[0].names
+        compiled = datastore_lazy.get([list_key], LazyThing)[0].names
+        self.assertEquals([u'a', u'b\xe4'], compiled)
+        self.assertEquals([type(value) for value in generic], [type(value) for value in compiled])
+
+        # a decoder for the wrong type falls back to the generic conversion
+        decode = datastore_lazy.compile_decoders(SomeModel)['foo']
+        proto = db.get(key)._populate_entity(datastore.Entity).ToPb()
+        baz = [p for p in proto.raw_property_list() if p.name() == 'baz'][0]
+        self.assertEquals(42, decode(baz))
+
+    def test_raw_lazy_entity(self):
+        class ListModel(db.Model):
+            names = db.StringListProperty(indexed=False)
+            number = db.IntegerProperty()
+
+        instance = SomeModel(foo=u'f\xf6o', bar='bar', baz=42)
+        instance.put()
+        serialized = instance._populate_entity(datastore.Entity).ToPb().SerializeToString()
+
+        lazy = datastore_lazy.LazyEntity.deserialize(serialized)
+        raw = datastore_lazy.RawLazyEntity.deserialize(serialized)
+        self.assertEquals(lazy.key(), raw.key())
+        for name in ('foo', 'bar', 'baz'):
+            self.assertEquals(getattr(lazy, name), getattr(raw, name))
+        with self.assertRaises(AttributeError):
+            raw.missing
+
+        instance = ListModel(names=['a', 'b', 'c'], number=7)
+        instance.put()
+        serialized = instance._populate_entity(datastore.Entity).ToPb().SerializeToString()
+        # embedded in a larger buffer
+        data = 'prefix' + serialized + 'suffix'
+        raw = datastore_lazy.RawLazyEntity(data, 6, len(serialized),
+            datastore_lazy.compile_decoders(ListModel))
+        self.assertEquals([u'a', u'b', u'c'], raw.names)
+        self.assertEquals(7, raw.number)
+
+    def test_compact_lazy_entity(self):
+        keys = db.put([SomeModel(foo='foo%d' % i, baz=i) for i in xrange(3)])
+        entities = datastore_lazy.get(keys, SomeModel, compact=True)
+        self.assertTrue(all(isinstance(e, datastore_lazy.CompactLazyEntity) for e in entities))
+        self.assertEquals(keys, [e.key() for e in entities])
+        self.assertEquals(['foo0', 'foo1', 'foo2'], [e.foo for e in entities])
+        self.assertEquals([0, 1, 2], [e.baz for e in entities])
+        self.assertEquals(None, entities[0].bar)
+        with self.assertRaises(AttributeError):
+            entities[0].missing
+        # read-only
+        with self.assertRaises(AttributeError):
+            entities[0].foo = 'changed'
+
+    def test_get_projection(self):
+        keys = db.put([SomeModel(foo='foo%d' % i, baz=i) for i in xrange(3)])
+        missing = db.Key.from_path('SomeModel', 'missing')
+
+        entities = datastore_lazy.get(keys + [missing], projection=['foo', 'bar', 'qux'])
+        self.assertEquals(None, entities[-1])
+        entity = entities[1]
+        self.assertTrue(isinstance(entity, datastore_lazy.ProjectedLazyEntity))
+        self.assertEquals(keys[1], entity.key())
+        self.assertEquals('foo1', entity.foo)
+        # db stores unset properties as None
+        self.assertEquals(None, entity.bar)
+        # fetched, but not stored on the entity
+        try:
+            entity.qux
+            self.fail('expected AttributeError')
+        except datastore_lazy.UnfetchedPropertyError:
+            self.fail('qux is in the projection')
+        except AttributeError:
+            pass
+        with self.assertRaises(datastore_lazy.UnfetchedPropertyError):
+            entity.baz
+
+        rpc = datastore_lazy.get_async(keys, model_class=SomeModel, projection=['baz'])
+        self.assertEquals([0, 1, 2], [e.baz for e in rpc.get_result()])
+        with self.assertRaises(ValueError):
+            datastore_lazy.get(keys, compact=True, projection=['foo'])
+
+    def test_concurrent_get(self):
+        keys = db.put([SomeModel(foo='foo%d' % i, baz=i) for i in xrange(5)])
+
+        def check(results):
+            for lazy_entity, model in results:
+                if not isinstance(lazy_entity, datastore_lazy.LazyEntity):
+                    return 'lazy get returned %s' % type(lazy_entity).__name__
+                if not isinstance(model, SomeModel):
+                    return 'db.get returned %s' % type(model).__name__
+            return None
+
+        # a datastore_lazy.get in one thread must not affect db.get in another
+        def get_both():
+            return zip(datastore_lazy.get(keys), db.get(keys))
+        _, _, errors = benchstats.run_concurrently(get_both, check, 8, 20)
+        self.assertEquals([], errors)
+
+    def test_get_columns(self):
+        keys = db.put([SomeModel(foo='foo%d' % i, baz=i) for i in xrange(3)])
+        missing = db.Key.from_path('SomeModel', 'missing')
+
+        columns = datastore_lazy.get_columns([keys[2], missing, keys[0]], ['foo', 'baz', 'nope'])
+        self.assertEquals([keys[2], keys[0]], columns['__key__'])
+        self.assertEquals(['foo2', 'foo0'], columns['foo'])
+        self.assertEquals([2, 0], columns['baz'])
+        self.assertEquals([None, None], columns['nope'])
+
+        columns = datastore_lazy.get_columns(keys, ['baz', 'bar'], SomeModel)
+        self.assertEquals(array.array('l', [0, 1, 2]), columns['baz'])
+        self.assertEquals([None, None, None], columns['bar'])
+
+    def test_lazy_model(self):
+        key = LazyThing(foo='foo', count=1, names=['a']).put()
+        # an entity stored without some properties
+        entity = datastore.Entity('LazyThing', name='partial')
+        entity['foo'] = u'partial'
+        partial_key = datastore.Put(entity)
+
+        instances = LazyThing.get([key, partial_key])
+        self.assertTrue(all(isinstance(i, LazyThing) for i in instances))
+        self.assertEquals(key, instances[0].key())
+        self.assertEquals(['foo', 1, ['a']], [instances[0].foo, instances[0].count, instances[0].names])
+        self.assertEquals(['partial', 5, []], [instances[1].foo, instances[1].count, instances[1].names])
+
+        self.assertTrue(instances[0].is_saved())
+
+        instances[0].count = 2
+        self.assertEquals(key, instances[0].put())
+        instance = db.get(key)
+        self.assertEquals(['foo', 2, ['a']], [instance.foo, instance.count, instance.names])
+        self.assertEquals('foo', LazyThing.get(key).foo)
+        # putting an instance that was never read writes all its properties
+        self.assertEquals(partial_key, LazyThing.get(partial_key).put())
+        self.assertEquals(['partial', 5, []],
+            [getattr(db.get(partial_key), name) for name in ('foo', 'count', 'names')])
+
+    def test_lazy_ndb_model(self):
+        key = LazyNdbThing(foo='foo', tags=['a', 'b'], number=3).put()
+        ndb.get_context().clear_cache()
+
+        # the default policy writes the fetched entity to memcache without loading anything
+        instance = key.get()
+        self.assertTrue(isinstance(instance, LazyNdbThing))
+        self.assertEquals(key, instance.key)
+        self.assertEquals(set(['foo', 'tags', 'number']), set(instance._values._pending))
+        ndb.get_context().clear_cache()
+        instance = key.get()
+        self.assertEquals(set(['foo', 'tags', 'number']), set(instance._values._pending))
+        self.assertEquals('foo', instance.foo)
+        self.assertEquals(set(['tags', 'number']), set(instance._values._pending))
+        self.assertEquals(['a', 'b'], instance.tags)
+
+        # the context cache returns the same partially loaded instance
+        self.assertIs(instance, key.get())
+
+        # changing a loaded list in place is written
+        instance.tags.append('c')
+        instance.number = 4
+        instance.put()
+        ndb.get_context().clear_cache()
+        instance = key.get(use_memcache=False)
+        expected = LazyNdbThing(key=key, foo='foo', tags=['a', 'b', 'c'], number=4)
+        self.assertEquals(expected, instance)
+        ndb.get_context().clear_cache()
+        self.assertEquals(expected, key.get())
+
+        # ndb keys work with datastore_lazy.get
+        self.assertEquals(4, datastore_lazy.get([key])[0].number)
+
+    def test_get_async(self):
+        keys = db.put([SomeModel(foo='foo%d' % i) for i in xrange(5)])
+        missing = db.Key.from_path('SomeModel', 'missing')
+
+        rpc1 = datastore_lazy.get_async(keys + [missing], batch_size=2)
+        rpc2 = datastore_lazy.get_async(keys[:1])
+        entities = rpc1.get_result()
+        self.assertEquals(keys, [entity.key() for entity in entities[:-1]])
+        self.assertEquals(['foo%d' % i for i in xrange(5)], [e.foo for e in entities[:-1]])
+        self.assertEquals(None, entities[-1])
+        self.assertEquals('foo0', rpc2.get_result()[0].foo)
+
+        # the thread's connection is not affected
+        self.assertTrue(isinstance(db.get(keys[0]), SomeModel))
+
+    def test_put(self):
+        key = SomeModel(foo='foo', bar='bar', baz=42).put()
+
+        entity = datastore_lazy.get([key])[0]
+        entity.foo = u'changed'
+        entity.bar = u'indexed'
+        del entity.baz
+        self.assertEquals([key], datastore_lazy.put([entity]))
+
+        instance = db.get(key)
+        self.assertEquals('changed', instance.foo)
+        self.assertEquals('indexed', instance.bar)
+        self.assertEquals(None, instance.baz)
+        # the indexed property is still queryable
+        self.assertEquals(key, SomeModel.all(keys_only=True).filter('bar =', 'indexed').get())
+
+        # putting a clean entity writes it back unchanged
+        datastore_lazy.put([datastore_lazy.get([key])[0]])
+        self.assertEquals('changed', db.get(key).foo)
+
+    def test_thread_connection(self):
+        # the lazy connection works with this SDK: nothing falls back to the slow path
+        self.assertEquals(None, datastore_lazy._SDK_ERROR)
+        self.assertEquals(None, datastore_lazy._check_sdk())
+
+        keys = db.put([SomeModel(foo='foo%d' % i, baz=i) for i in xrange(3)])
+        connection = datastore._GetConnection()
+        adapter = connection.adapter
+
+        self.assertEquals('foo1', datastore_lazy.get(keys)[1].foo)
+        # the thread's connection is never modified, and the lazy connection is reused
+        self.assertTrue(connection.adapter is adapter)
+        self.assertTrue(datastore_lazy._lazy_connection() is datastore_lazy._lazy_connection())
+        self.assertFalse(datastore_lazy._lazy_connection() is
+            datastore_lazy._lazy_connection(SomeModel))
+        # projections are not cached, so the cache stays bounded
+        cached = len(datastore_lazy._local.connections)
+        for i in xrange(3):
+            datastore_lazy.get(keys, projection=['foo%d' % i])
+        self.assertEquals(cached, len(datastore_lazy._local.connections))
+
+        def in_transaction():
+            entity = datastore_lazy.get(keys[:1])[0]
+            self.assertTrue(isinstance(entity, datastore_lazy.LazyEntity))
+            entity.foo = u'changed'
+            datastore_lazy.put([entity])
+            raise db.Rollback()
+        db.run_in_transaction(in_transaction)
+        self.assertEquals('foo0', db.get(keys[0]).foo)
+
+    def test_sdk_fallback(self):
+        keys = db.put([SomeModel(foo='foo%d' % i, baz=i) for i in xrange(3)])
+        missing = db.Key.from_path('SomeModel', 'missing')
+        original_error = datastore_lazy._SDK_ERROR
+        datastore_lazy._SDK_ERROR = 'testing'
+        try:
+            entities = datastore_lazy.get(keys + [missing], model_class=SomeModel)
+            self.assertEquals(None, entities[-1])
+            self.assertTrue(isinstance(entities[0], datastore_lazy.LazyEntity))
+            self.assertEquals([0, 1, 2], [e.baz for e in entities[:-1]])
+            rpc = datastore_lazy.get_async(keys, compact=True)
+            self.assertEquals(keys, [e.key() for e in rpc.get_result()])
+            self.assertEquals(['foo0'], datastore_lazy.get_columns(keys[:1], ['foo'])['foo'])
+            self.assertEquals(3, len(list(datastore_lazy.query('SomeModel'))))
+
+            entities[0].foo = u'changed'
+            self.assertEquals(keys[:1], datastore_lazy.put(entities[:1]))
+            self.assertEquals('changed', db.get(keys[0]).foo)
+        finally:
+            datastore_lazy._SDK_ERROR = original_error
+
+    def test_model_to_pb(self):
+        class WideModel(db.Expando):
+            name = db.StringProperty()
+            unindexed = db.StringProperty(indexed=False)
+            count = db.IntegerProperty()
+            ratio = db.FloatProperty(indexed=False)
+            flag = db.BooleanProperty()
+            text = db.TextProperty()
+            names = db.StringListProperty()
+            missing = db.IntegerProperty()
+
+        instance = WideModel(name=u'n\xe4me', unindexed='u', count=3, ratio=0.5, flag=True,
+            text=u'text', names=['a', 'b'], dynamic=7)
+        for model in (instance, WideModel(key_name='named', parent=db.Key.from_path('P', 1),
+                name='x')):
+            expected = db.model_to_protobuf(model)
+            actual = datastore_lazy.model_to_pb(model)
+            self.assertEquals(expected.key(), actual.key())
+            self.assertEquals(expected.entity_group(), actual.entity_group())
+            for prop_list in ('property_list', 'raw_property_list'):
+                self.assertEquals(
+                    sorted(p.Encode() for p in getattr(expected, prop_list)()),
+                    sorted(p.Encode() for p in getattr(actual, prop_list)()))
+
+        # a model without a key is written to the current namespace, like db.put
+        namespace_manager.set_namespace('other')
+        try:
+            model = WideModel(name='x')
+            self.assertEquals('other', datastore_lazy.model_to_pb(model).key().name_space())
+            key = datastore_lazy.put([model])[0]
+        finally:
+            namespace_manager.set_namespace('')
+        self.assertEquals('other', key.namespace())
+
+        # the fast path writes models and sets the allocated key
+        keys = datastore_lazy.put([instance])
+        self.assertTrue(instance.is_saved())
+        self.assertEquals(keys, [instance.key()])
+        stored = db.get(keys[0])
+        self.assertEquals(u'n\xe4me', stored.name)
+        self.assertEquals(['a', 'b'], stored.names)
+        self.assertEquals(7, stored.dynamic)
+        instance.count = 4
+        self.assertEquals(keys, datastore_lazy.put([instance]))
+        self.assertEquals(4, db.get(keys[0]).count)
+        # still works with db after the fast path
+        instance.count = 5
+        instance.put()
+        self.assertEquals(5, db.get(keys[0]).count)
+
+    def test_put_auto_now(self):
+        class Stamped(db.Model):
+            updated = db.DateTimeProperty(auto_now=True)
+            name = db.StringProperty()
+
+        old = datetime.datetime(2000, 1, 1)
+        instance = Stamped(updated=old, name='a')
+        # like db.put, auto_now properties are updated; the model gets the stored value too
+        key = datastore_lazy.put([instance])[0]
+        self.assertTrue(instance.updated > old)
+        self.assertEquals(instance.updated, db.get(key).updated)
+        # serializing without putting does not update it
+        updated = instance.updated
+        datastore_lazy.model_to_pb(instance)
+        self.assertEquals(updated, instance.updated)
+
+    def test_query(self):
+        keys = db.put([SomeModel(foo='foo%d' % i, bar='bar', baz=i) for i in xrange(5)])
+        SomeModel(foo='other', bar='other').put()
+
+        results = datastore_lazy.query('SomeModel', {'bar =': 'bar'}, batch_size=2)
+        entities = sorted(results, key=lambda entity: entity.baz)
+        self.assertEquals(keys, [entity.key() for entity in entities])
+        self.assertEquals('foo3', entities[3].foo)
+
+        results = list(datastore_lazy.run_query(SomeModel.all(keys_only=True), limit=3))
+        self.assertEquals(3, len(results))
+        self.assertTrue(all(isinstance(key, db.Key) for key in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
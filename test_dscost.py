@@ -0,0 +1,73 @@
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import dscost
+
+
+class SomeModel(db.Model):
+    foo = db.StringProperty(indexed=False)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # queries must see writes immediately
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_middleware(self):
+        keys = db.put([SomeModel(foo='foo%d' % i) for i in xrange(3)])
+        missing = db.Key.from_path('SomeModel', 'missing')
+
+        def app(environ, start_response):
+            db.get(keys + [missing])
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['ok']
+
+        responses = []
+        def start_response(status, response_headers, exc_info=None):
+            responses.append((status, dict(response_headers)))
+
+        middleware = dscost.CostMiddleware(app)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+        self.assertEquals(['ok'], middleware(environ, start_response))
+        status, headers = responses[0]
+        self.assertEquals('200 OK', status)
+        self.assertEquals('text/plain', headers['Content-Type'])
+        self.assertEquals('1', headers['X-Datastore-Rpcs'])
+        self.assertEquals('3', headers['X-Datastore-Entities'])
+        self.assertGreater(int(headers['X-Datastore-Bytes']), 0)
+        self.assertIn('X-Datastore-Conversion-Wall-Ms', headers)
+
+        # only requests with the parameter are recorded
+        middleware = dscost.CostMiddleware(app, query_param='dscost')
+        del responses[:]
+        middleware(environ, start_response)
+        self.assertNotIn('X-Datastore-Rpcs', responses[0][1])
+        middleware(dict(environ, QUERY_STRING='a=b&dscost=1'), start_response)
+        self.assertEquals('3', responses[1][1]['X-Datastore-Entities'])
+
+    def test_record(self):
+        db.put([SomeModel(foo='foo%d' % i) for i in xrange(3)])
+
+        with dscost.record() as cost:
+            self.assertEquals(3, len(SomeModel.all().fetch(10)))
+        self.assertEquals(3, cost.entities)
+        self.assertGreater(cost.conversion_seconds, 0)
+        self.assertIn('3 entities', cost.summary())
+
+        # outside record() nothing is counted
+        SomeModel.all().fetch(10)
+        self.assertEquals(3, cost.entities)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import logging
+import unittest
+
+from google.appengine.api import datastore_types
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import dsprofile
+
+
+class SomeModel(db.Model):
+    foo = db.StringProperty(indexed=False)
+    bar = db.IntegerProperty(indexed=False)
+
+
+class SomeNdbModel(ndb.Model):
+    foo = ndb.StringProperty(indexed=False)
+    bar = ndb.IntegerProperty(indexed=False)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_profile(self):
+        keys = db.put([SomeModel(foo='foo', bar=i) for i in xrange(3)])
+        ndb_keys = ndb.put_multi([SomeNdbModel(foo='foo', bar=i) for i in xrange(3)])
+
+        with dsprofile.profile(cprofile=True) as profiler:
+            self.assertEquals(3, len(db.get(keys)))
+        self.assertGreaterEqual(profiler.calls[dsprofile.RPC_WAIT], 1)
+        self.assertEquals(3, profiler.calls[dsprofile.PB_TO_ENTITY])
+        self.assertEquals(3, profiler.calls[dsprofile.FROM_ENTITY])
+        self.assertEquals(6, profiler.calls[dsprofile.PROPERTY_CONVERSION])
+        self.assertAlmostEquals(profiler.total, sum(profiler.times.values()), places=3)
+        self.assertIn('from_entity', profiler.summary())
+        self.assertIn('FromPropertyPb', profiler.format_stats(dsprofile.PROPERTY_CONVERSION))
+
+        with dsprofile.profile() as profiler:
+            ndb.get_multi(ndb_keys, use_cache=False, use_memcache=False)
+            # a nested profile is not recorded in the outer one
+            with dsprofile.profile() as inner:
+                db.get(keys)
+        self.assertEquals(3, profiler.calls[dsprofile.PB_TO_ENTITY])
+        self.assertEquals(0, profiler.calls[dsprofile.FROM_ENTITY])
+        self.assertEquals(6, profiler.calls[dsprofile.PROPERTY_CONVERSION])
+        self.assertEquals(3, inner.calls[dsprofile.FROM_ENTITY])
+        self.assertEquals(None, profiler.stats(dsprofile.OTHER))
+
+        # not recorded outside a profile
+        db.get(keys)
+        self.assertEquals(3, inner.calls[dsprofile.FROM_ENTITY])
+
+    def test_install(self):
+        original = datastore_types.FromPropertyPb
+        original_from_entity = db.Model.__dict__['from_entity']
+        # only patched while a profile is active
+        with dsprofile.profile():
+            self.assertIsNot(original, datastore_types.FromPropertyPb)
+            with dsprofile.profile():
+                pass
+            self.assertIsNot(original, datastore_types.FromPropertyPb)
+        self.assertIs(original, datastore_types.FromPropertyPb)
+        self.assertIs(original_from_entity, db.Model.__dict__['from_entity'])
+
+        dsprofile.install()
+        try:
+            with dsprofile.profile():
+                pass
+            self.assertIsNot(original, datastore_types.FromPropertyPb)
+        finally:
+            dsprofile.uninstall()
+        self.assertIs(original, datastore_types.FromPropertyPb)
+
+    def test_middleware(self):
+        keys = db.put([SomeModel(foo='foo', bar=1)])
+        def app(environ, start_response):
+            db.get(keys)
+            return ['ok']
+
+        messages = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+        handler = Handler()
+        logging.getLogger().addHandler(handler)
+        logging.getLogger().setLevel(logging.INFO)
+        try:
+            environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/path'}
+            self.assertEquals(['ok'], dsprofile.ProfileMiddleware(app, 0)(environ, None))
+            self.assertEquals([], messages)
+            self.assertEquals(['ok'], dsprofile.ProfileMiddleware(app, 1)(environ, None))
+            self.assertEquals(1, len(messages))
+            self.assertIn('GET /path: total', messages[0])
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import datastore_lazy
+import entity_cache
+
+
+class SomeModel(db.Model):
+    foo = db.StringProperty(indexed=False)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_lru(self):
+        cache = entity_cache.EntityCache(max_bytes=10)
+        cache.put_serialized('a', 'aaaa')
+        cache.put_serialized('b', 'bbbb')
+        self.assertEquals('aaaa', cache.get_serialized('a'))
+        # evicts b: a was used more recently
+        cache.put_serialized('c', 'cccc')
+        self.assertEquals(None, cache.get_serialized('b'))
+        self.assertEquals('cccc', cache.get_serialized('c'))
+        # too big to cache
+        cache.put_serialized('d', 'd' * 11)
+        self.assertEquals(None, cache.get_serialized('d'))
+
+        self.assertEquals({'hits': 2, 'misses': 2, 'evictions': 1, 'entities': 2, 'bytes': 8},
+            cache.stats())
+        cache.invalidate(['a', 'missing'])
+        self.assertEquals(1, len(cache))
+        self.assertEquals(4, cache.size_bytes())
+
+    def test_get(self):
+        cache = entity_cache.EntityCache()
+        keys = db.put([SomeModel(foo='foo%d' % i) for i in xrange(3)])
+        missing = db.Key.from_path('SomeModel', 'missing')
+
+        entities = entity_cache.get(keys[:2] + [missing], cache=cache)
+        self.assertEquals(['foo0', 'foo1'], [e.foo for e in entities[:2]])
+        self.assertEquals(None, entities[2])
+        self.assertEquals(2, len(cache))
+
+        entities = entity_cache.get(keys, cache=cache)
+        self.assertTrue(isinstance(entities[0], datastore_lazy.RawLazyEntity))
+        self.assertEquals(keys, [e.key() for e in entities])
+        self.assertEquals(['foo0', 'foo1', 'foo2'], [e.foo for e in entities])
+        self.assertEquals(2, cache.hits)
+
+        entity = datastore_lazy.get(keys[:1])[0]
+        entity.foo = u'changed'
+        entity_cache.put([entity], cache=cache)
+        self.assertEquals('changed', entity_cache.get(keys[:1], cache=cache)[0].foo)
+
+    def test_get_memcache(self):
+        keys = db.put([SomeModel(foo='foo%d' % i) for i in xrange(3)])
+
+        # fills memcache as well as the local cache
+        stats = entity_cache.GetStats()
+        entity_cache.get(keys[:2], cache=entity_cache.EntityCache(), use_memcache=True,
+            stats=stats)
+        self.assertEquals(2, stats.datastore_entities)
+        self.assertEquals(0, stats.datastore_round_trips_saved)
+
+        # a new instance: entities come from memcache, even though they were deleted
+        db.delete(keys[:2])
+        cache = entity_cache.EntityCache()
+        stats = entity_cache.GetStats()
+        entities = entity_cache.get(keys[:2], cache=cache, use_memcache=True, stats=stats)
+        self.assertEquals(['foo0', 'foo1'], [e.foo for e in entities])
+        self.assertEquals(2, stats.memcache_hits)
+        self.assertEquals(0, stats.datastore_round_trips)
+        self.assertEquals(1, stats.datastore_round_trips_saved)
+        self.assertEquals(2, len(cache))
+
+        # only the miss goes to the datastore
+        stats = entity_cache.GetStats()
+        entities = entity_cache.get(keys, cache=entity_cache.EntityCache(), use_memcache=True,
+            stats=stats)
+        self.assertEquals(['foo0', 'foo1', 'foo2'], [e.foo for e in entities])
+        self.assertEquals(1, stats.datastore_entities)
+
+        entity_cache.invalidate(keys, cache=cache, use_memcache=True)
+        entities = entity_cache.get(keys[:2], cache=cache, use_memcache=True)
+        self.assertEquals([None, None], entities)
+
+    def test_get_memcache_invalidated(self):
+        keys = db.put([SomeModel(foo='foo%d' % i) for i in xrange(2)])
+
+        # another request writes and invalidates after the datastore read, before the entities
+        # would be added to memcache
+        original_get = datastore_lazy.get
+        def get_then_invalidate(keys, model_class=None):
+            entities = original_get(keys, model_class)
+            entity_cache.invalidate(keys[:1], cache=entity_cache.EntityCache(), use_memcache=True)
+            return entities
+        datastore_lazy.get = get_then_invalidate
+        try:
+            entity_cache.get(keys, cache=entity_cache.EntityCache(), use_memcache=True)
+        finally:
+            datastore_lazy.get = original_get
+
+        found = memcache.get_multi([str(key) for key in keys],
+            key_prefix=entity_cache.MEMCACHE_KEY_PREFIX)
+        self.assertEquals([str(keys[1])], found.keys())
+
+
+if __name__ == "__main__":
+    unittest.main()
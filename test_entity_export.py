@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import entity_export
+
+
+class SomeModel(db.Model):
+    foo = db.StringProperty(indexed=False)
+    bar = db.IntegerProperty()
+    names = db.StringListProperty(indexed=False)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.testbed.deactivate()
+
+    def test_export(self):
+        keys = db.put([SomeModel(foo='foo%d' % i, bar=i, names=['a'] * (i % 2)) for i in xrange(5)])
+
+        for compress in (False, True):
+            path = os.path.join(self.directory, 'export%d' % compress)
+            self.assertEquals(5, entity_export.export_kind('SomeModel', path, compress=compress,
+                batch_size=2))
+
+            with entity_export.ExportReader(path, SomeModel) as reader:
+                self.assertEquals('SomeModel', reader.kind)
+                self.assertEquals(5, reader.count)
+                self.assertEquals({'foo': 5, 'bar': 5, 'names': 2}, reader.property_counts)
+                entities = sorted(reader, key=lambda entity: entity.bar)
+                self.assertEquals(keys, [entity.key() for entity in entities])
+                self.assertEquals(['foo%d' % i for i in xrange(5)], [e.foo for e in entities])
+                self.assertEquals([u'a'], entities[1].names)
+
+    def test_writer_chunks(self):
+        entity = SomeModel(key_name='x', foo='foo', bar=1)
+        proto = db.model_to_protobuf(entity)
+        path = os.path.join(self.directory, 'chunks')
+        with open(path, 'wb') as f:
+            writer = entity_export.ExportWriter(f, 'SomeModel', compress=True, chunk_size=100)
+            for _ in xrange(50):
+                writer.write_proto(proto)
+            writer.close()
+
+        reader = entity_export.ExportReader(path)
+        self.assertEquals(['foo'] * 50, [entity.foo for entity in reader])
+        reader.close()
+
+        with open(path, 'wb') as f:
+            f.write('not an export')
+        with self.assertRaises(ValueError):
+            entity_export.ExportReader(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
+import datetime
+import random
 import unittest
 
 from google.appengine.ext import db
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
 
 import modelgen
 
@@ -11,6 +15,14 @@ class SomeModel(db.Model):
 
 
 class Test(unittest.TestCase):
+    def setUp(self):
+        # keys need an application id
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
     def test_code(self):
         output = modelgen.code(10)
 
@@ -27,6 +39,67 @@ class Test(unittest.TestCase):
         self.assertEquals(modelgen.STRING_LENGTH, len(instance.bar))
         self.assertNotEquals(instance.foo, instance.bar)
 
+    def test_schema(self):
+        specs = modelgen.parse_schema(
+            'string*2:indexed,int,text:size=100-200,key*2:repeated:length=4,datetime,float,bool')
+        self.assertEquals(7, len(specs))
+        self.assertEquals((100, 200), specs[2].size)
+        self.assertTrue(specs[3].repeated)
+        with self.assertRaises(ValueError):
+            modelgen.parse_schema('blob')
+        with self.assertRaises(ValueError):
+            modelgen.parse_schema('text:indexed')
+
+        names = [name for name, _ in modelgen.property_specs(specs)]
+        self.assertEquals(['string_a', 'string_b', 'int_c', 'text_d', 'key_e', 'key_f',
+            'datetime_g', 'float_h', 'bool_i'], names)
+
+        for ndb_model in (False, True):
+            model_class = modelgen.model_class('Schema%d' % ndb_model, specs, ndb_model)
+            instance = modelgen.instance(model_class)
+            self.assertTrue(100 <= len(instance.text_d) <= 200)
+            self.assertEquals(4, len(instance.key_e))
+            self.assertTrue(isinstance(instance.int_c, (int, long)))
+            self.assertTrue(isinstance(instance.datetime_g, datetime.datetime))
+
+            # types are inferred for classes not created by model_class
+            class_name = 'Plain%d' % ndb_model
+            exec_globals = {}
+            exec (modelgen.SCHEMA_IMPORTS + '\n' +
+                modelgen.schema_code(class_name, specs, ndb_model)) in exec_globals
+            instance = modelgen.instance(exec_globals[class_name])
+            self.assertEquals(modelgen.STRING_LENGTH, len(instance.string_a))
+            self.assertEquals(modelgen.LIST_LENGTH, len(instance.key_f))
+
+    def test_bulk_generator(self):
+        specs = modelgen.parse_schema('string*3:indexed,text:size=5-10,int,key:repeated')
+        model_class = modelgen.model_class('BulkModel', specs)
+
+        first = modelgen.BulkGenerator(model_class, seed=1)
+        protos = list(first.entity_protos(3))
+        self.assertEquals([p.Encode() for p in protos],
+            [p.Encode() for p in modelgen.BulkGenerator(model_class, seed=1).entity_protos(3)])
+        self.assertNotEquals(protos[0].Encode(),
+            modelgen.BulkGenerator(model_class, seed=2).entity_protos(1).next().Encode())
+
+        instance = db.model_from_protobuf(protos[1])
+        self.assertEquals(db.Key.from_path('BulkModel', 2), instance.key())
+        self.assertEquals(modelgen.STRING_LENGTH, len(instance.string_a))
+        self.assertTrue(5 <= len(instance.text_d) <= 10)
+        self.assertEquals(modelgen.LIST_LENGTH, len(instance.key_f))
+        self.assertEquals(['string_a', 'string_b', 'string_c'],
+            sorted(p.name() for p in protos[1].property_list()))
+
+        ndb_class = modelgen.model_class('NdbBulkModel', specs, ndb_model=True)
+        values = modelgen.BulkGenerator(ndb_class).property_dicts(2).next()
+        instance = ndb_class(**values)
+        self.assertTrue(all(isinstance(key, ndb.Key) for key in instance.key_f))
+
+        letters = modelgen.random_letters(random.Random(0), 50)
+        self.assertEquals(50, len(letters))
+        self.assertTrue(set(letters) <= set(modelgen.LETTERS))
+        self.assertEquals('', modelgen.random_letters(random.Random(0), 0))
+
 
 if __name__ == "__main__":
     unittest.main()